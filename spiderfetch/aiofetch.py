@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+#
+# An event loop driven alternative to fetch.MyURLopener. http and https are
+# spoken over asyncio streams, so a single thread can keep thousands of
+# transfers going. ftp and downloads split into --segments are still handed
+# to the blocking opener, on a thread.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import asyncio
+import base64
+import email.parser
+import os
+import socket
+import ssl
+import sys
+import threading
+import time
+import traceback
+
+from spiderfetch import fetch
+from spiderfetch import httpcache
+from spiderfetch import ioutils
+from spiderfetch import manifest
+from spiderfetch import ratelimit
+from spiderfetch import retry
+from spiderfetch import urlrewrite
+from spiderfetch import workerpool
+from spiderfetch.compat import ContentTooShortError
+from spiderfetch.compat import httplib
+from spiderfetch.compat import urlparse
+
+
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+_ssl_context = ssl.create_default_context()
+
+
+class AsyncFetcher(fetch.Fetcher):
+    """A Fetcher whose launch methods are coroutines. Request headers are
+    still kept on the MyURLopener, so Referer, Range and friends are shared
+    with the blocking engine."""
+
+    async def wait(self, aw):
+        try:
+            return await asyncio.wait_for(aw, fetch.timeout)
+        except asyncio.TimeoutError:
+            raise IOError('socket error', socket.timeout())
+        except ssl.SSLError as e:
+            raise IOError('socket error', e)
+        except socket.gaierror as e:
+            raise IOError('socket error', e)
+        except (ConnectionError, OSError) as e:
+            raise IOError('socket error', e)
+
+    async def open(self, url):
+        """Send the request, returns (reader, writer, status, headers)"""
+        pack = urlparse.urlsplit(url)
+        if pack.scheme == "https":
+            (port, context) = (pack.port or 443, _ssl_context)
+        else:
+            (port, context) = (pack.port or 80, None)
+        (reader, writer) = await self.wait(
+            asyncio.open_connection(pack.hostname, port, ssl=context))
+
+        selector = urlparse.urlunsplit(('', '', pack.path or '/', pack.query, ''))
+        host = pack.hostname
+        if pack.port:
+            host = "%s:%s" % (host, pack.port)
+        lines = ["GET %s HTTP/1.1" % selector, "Host: %s" % host]
+        for (k, v) in self._opener.addheaders:
+            # the connection is ours alone, whatever the pooled opener says
+            if k.lower() == "connection":
+                continue
+            lines.append("%s: %s" % (k, v))
+        if pack.username:
+            auth = "%s:%s" % (urlparse.unquote(pack.username),
+                              urlparse.unquote(pack.password or ''))
+            auth = base64.b64encode(auth.encode()).decode('ascii')
+            lines.append("Authorization: Basic %s" % auth)
+        lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+        status_line = await self.wait(reader.readline())
+        try:
+            (_, status, _) = (status_line.decode('latin-1').split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            writer.close()
+            raise IOError('http error', 'bad status line: %r' % status_line)
+
+        header_lines = []
+        while True:
+            line = await self.wait(reader.readline())
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line.decode('latin-1'))
+        headers = email.parser.Parser(_class=httplib.HTTPMessage).parsestr(
+            "".join(header_lines))
+
+        return reader, writer, status, headers
+
+    async def read_body(self, reader, headers):
+        """Yields the blocks of the response body, asking for more at a time
+        while the stream keeps up"""
+        bs = fetch.CHUNK_SIZE
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                line = await self.wait(reader.readline())
+                chunksize = int(line.split(b';')[0].strip() or b'0', 16)
+                if not chunksize:
+                    return
+                while chunksize > 0:
+                    block = await self.wait(reader.read(min(bs, chunksize)))
+                    if not block:
+                        return
+                    chunksize -= len(block)
+                    if len(block) == bs:
+                        bs = min(bs * 2, fetch.MAX_CHUNK_SIZE)
+                    yield block
+                await self.wait(reader.readline())
+        else:
+            remaining = -1
+            if "content-length" in headers:
+                remaining = int(headers["content-length"])
+            while remaining:
+                n = bs
+                if remaining > 0:
+                    n = min(bs, remaining)
+                block = await self.wait(reader.read(n))
+                if not block:
+                    return
+                if remaining > 0:
+                    remaining -= len(block)
+                if len(block) == n == bs:
+                    bs = min(bs * 2, fetch.MAX_CHUNK_SIZE)
+                yield block
+
+    async def retrieve(self, url, filename, reporthook=None, cont=None,
+                       datahook=None):
+        """Counterpart of MyURLopener.retrieve"""
+        loop = asyncio.get_running_loop()
+        opener = self._opener
+        size = -1
+        read = 0
+        state = None
+        if cont:
+            (state, localsize) = await loop.run_in_executor(
+                None, opener.continue_manifest, url, filename)
+            if not state:
+                localsize = await loop.run_in_executor(None, opener.continue_file, filename)
+            read = localsize
+
+        # revalidate pages we have seen before
+        cache = httpcache.get_cache()
+        if cont or not self.mode == self.SPIDER:
+            cache = None
+        if cache:
+            for pair in await loop.run_in_executor(None, cache.validators, url):
+                opener.set_header(pair)
+
+        for _ in range(MAX_REDIRECTS):
+            (reader, writer, status, headers) = await self.open(url)
+            if status not in REDIRECTS:
+                break
+            writer.close()
+            newurl = urlparse.urljoin(url, headers.get("location") or
+                                      headers.get("uri") or "")
+            if not os.environ.get("SILENT_REDIRECT"):
+                raise fetch.ChangedUrlWarning(urlparse.urljoin(self.url, newurl))
+            url = newurl
+        else:
+            raise IOError('http error', 'redirect loop')
+
+        try:
+            if status == 304 and cache:
+                return await loop.run_in_executor(
+                    None, opener.restore_cached, cache, url, filename,
+                    reporthook, datahook)
+            if status not in (200, 203, 206):
+                self.handle_error(getattr(fetch.err, 'http_' + str(status)))
+                raise fetch.ErrorAlreadyProcessed
+
+            self.content_type = headers.get("content-type")
+            self.check_content_type()
+            body = self.read_body(reader, headers)
+            tfp = None
+
+            # the file and the manifest, which is synced to disk every so
+            # often, are written on the executor so no other transfer on the
+            # loop waits for the disk
+            def open_at(offset):
+                tfp = open(filename, 'rb+')
+                tfp.seek(offset)
+                tfp.truncate()
+                return tfp
+
+            def open_tail():
+                tfp = open(filename, 'rb+')
+                tfp.seek(-opener.checksum_size, os.SEEK_END)
+                return tfp, tfp.read(opener.checksum_size)
+
+            def start(tfp):
+                state.start(headers, read)
+                if state.size > read and state.get_validator():
+                    ioutils.preallocate(tfp, state.size)
+
+            def write(tfp, blocks):
+                for data in blocks:
+                    tfp.write(data)
+                    if state:
+                        state.update(data, tfp)
+                    if datahook:
+                        datahook(data)
+
+            # drop what was reserved and not written, on failure too
+            def truncate(tfp):
+                if state and state.size > tfp.tell():
+                    tfp.truncate()
+
+            try:
+                if state and not opener.resumes_at(headers, localsize, state):
+                    # the file has changed on the server, start over
+                    (cont, state, read) = (False, None, 0)
+                if cont and state:
+                    tfp = await loop.run_in_executor(None, open_at, localsize)
+                elif cont:
+                    if not headers.get("content-range"):
+                        raise fetch.ResumeNotSupported
+                    (tfp, local) = await loop.run_in_executor(None, open_tail)
+                    remote = b''
+                    async for block in body:
+                        remote += block
+                        if len(remote) >= opener.checksum_size:
+                            break
+                    (remote, rest) = (remote[:opener.checksum_size],
+                                      remote[opener.checksum_size:])
+                    if not local == remote:
+                        raise fetch.ResumeChecksumFailed
+                    await loop.run_in_executor(None, tfp.write, rest)
+                    read += len(rest)
+                else:
+                    tfp = await loop.run_in_executor(None, ioutils.open_file, filename, 'wb')
+                result = filename, headers
+
+                if reporthook:
+                    if "content-length" in headers:
+                        size = int(headers["Content-Length"])
+                        if cont:
+                            size = size + localsize
+                            if not state:
+                                size -= opener.checksum_size
+                    reporthook(read, 1, size)
+                if opener.keeps_manifest(filename):
+                    state = state or manifest.Manifest(filename, url)
+                    await loop.run_in_executor(None, start, tfp)
+                decoder = opener.get_decoder(headers)
+                host = urlrewrite.get_hostname(url)
+                reported = time.time()
+                async for block in body:
+                    read += len(block)
+                    delay = ratelimit.limiter.take_bytes(host, len(block))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    blocks = [block]
+                    if decoder:
+                        blocks = decoder.decode(block)
+                    await loop.run_in_executor(None, write, tfp, blocks)
+                    if reporthook and time.time() - reported >= fetch.REPORT_INTERVAL:
+                        reported = time.time()
+                        reporthook(read, 1, size)
+                if decoder:
+                    await loop.run_in_executor(None, write, tfp, decoder.flush())
+                    self.wire_size = read
+                if reporthook:
+                    reporthook(read, 1, size)
+            finally:
+                if tfp:
+                    await loop.run_in_executor(None, truncate, tfp)
+                    await loop.run_in_executor(None, ioutils.close_file, tfp, filename)
+        finally:
+            writer.close()
+
+        # raise exception if actual size does not match content-length header
+        if size >= 0 and read < size:
+            raise ContentTooShortError("retrieval incomplete: got only %i out "
+                                       "of %i bytes" % (read, size), result)
+
+        if state:
+            await loop.run_in_executor(None, state.remove)
+        if cache:
+            await loop.run_in_executor(None, cache.store, url, headers, filename)
+
+        return result
+
+    async def inner_load_url(self):
+        loop = asyncio.get_running_loop()
+        cont = await loop.run_in_executor(None, self.prepare)
+
+        # ftp and segmented downloads use the blocking opener, on a thread
+        if self.proto == self.PROTO_FTP or self.get_segments(cont) > 1:
+            await loop.run_in_executor(None, self.transfer, cont)
+        else:
+            await self.retrieve(self.url, self.fileobj or self.filename,
+                                reporthook=self.fetch_hook, cont=cont,
+                                datahook=self.data_hook)
+
+    async def load_url(self):
+        self.write_progress(prestart=True)
+
+        await self.inner_load_url()
+
+        # the extractor has the rest of the page to get through
+        await asyncio.get_running_loop().run_in_executor(None, self.finish_load_url)
+
+    async def launch(self):
+        try:
+            # clear error
+            self.error = None
+
+            await self.load_url()
+        except Exception:
+            self.handle_exception()
+
+    async def launch_w_tries(self):
+        while True:
+            self.tries -= 1
+            self.attempts += 1
+
+            await self.launch()
+
+            if not self.error or not fetch.err.is_temporal(self.error):
+                return
+
+            if self.tries < 1:
+                return
+
+            # retry after a delay that grows with every try
+            self.retry_wait = int(retry.backoff(self.attempts, fetch.RETRY_WAIT))
+            self.write_progress(wait=True)
+            await asyncio.sleep(self.retry_wait)
+
+
+async def fetch_record(spiderfetcher, record, rule):
+    """Counterpart of SpiderFetcher.fetch_record. Following redirects,
+    handing pages to the parse pool and giving up on a record take locks
+    that threads hold too, so they're done on the executor."""
+    loop = asyncio.get_running_loop()
+    f = spiderfetcher.new_fetcher(record, cls=AsyncFetcher)
+    if spiderfetcher.blocked(f):
+        return f
+    try:
+        while True:
+            try:
+                await f.launch_w_tries()
+                job = await loop.run_in_executor(None, spiderfetcher.submit_parse, f)
+                if job:
+                    (future, cleanup) = job
+                    try:
+                        f.urls = await asyncio.wrap_future(future)
+                    finally:
+                        cleanup()
+                return f
+            except fetch.ChangedUrlWarning as e:
+                f.url = await loop.run_in_executor(
+                    None, spiderfetcher.follow_redirect, f.url, e.new_url,
+                    rule.get("host_filter"))
+    except Exception as exc:
+        await loop.run_in_executor(None, spiderfetcher.abandon, f, exc,
+                                   traceback.format_exc())
+
+
+class AsyncPool(workerpool.WorkerPool):
+    """A WorkerPool that runs func(record), a coroutine, as a task on an event
+    loop in a background thread instead of on a set of threads. Here workers
+    is just the number of records in flight, so it can be set very high."""
+
+    def __init__(self, func, workers, host_conns=None, limiter=None):
+        workerpool.WorkerPool.__init__(self, func, workers, host_conns=host_conns,
+                                       limiter=limiter)
+        self.loop = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        t = threading.Thread(target=self.loop.run_forever)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+        self.threads = []
+
+    async def work(self, host, record):
+        result = None
+        try:
+            result = await self.func(record)
+        except Exception:
+            ioutils.write_err(traceback.format_exc())
+        self.results.put((host, record, result))
+
+    def run(self, host, record):
+        asyncio.run_coroutine_threadsafe(self.work(host, record), self.loop)
+
+
+
+if __name__ == "__main__":
+    (parser, a) = ioutils.init_opts("<url>+ [options]")
+    (opts, args) = ioutils.parse_args(parser)
+    if not args:
+        ioutils.opts_help(None, None, None, parser)
+
+    async def main(urls):
+        fetchers = []
+        for url in urls:
+            filename = urlrewrite.url_to_filename(url)
+            if not manifest.Manifest.exists(filename):
+                filename = ioutils.safe_filename(filename)
+            fetchers.append(AsyncFetcher(mode=fetch.Fetcher.FETCH, url=url,
+                                         filename=filename))
+        await asyncio.gather(*[f.launch_w_tries() for f in fetchers])
+
+    os.environ["SILENT_REDIRECT"] = "1"
+    os.environ["ORIG_FILENAMES"] = os.environ.get("ORIG_FILENAMES") or "1"
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        ioutils.write_abort()
+        sys.exit(1)
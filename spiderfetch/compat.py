@@ -29,8 +29,38 @@ try:
 except ImportError:
     from urllib.request import ftpwrapper  # noqa
 
+try:
+    from urllib import addclosehook, addinfourl, ftperrors
+except ImportError:
+    from urllib.response import addclosehook, addinfourl  # noqa
+    from urllib.request import ftperrors  # noqa
+
 
 try:
     from urllib import unwrap
 except ImportError:
     from urllib.request import unwrap  # noqa
+
+
+try:
+    from HTMLParser import HTMLParser
+except ImportError:
+    from html.parser import HTMLParser  # noqa
+
+
+try:
+    from socket import sslerror
+except ImportError:
+    from ssl import SSLError as sslerror  # noqa
+
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue  # noqa
+
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # noqa
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import threading
+import time
+
+from spiderfetch.compat import BaseHTTPRequestHandler, HTTPServer
+from spiderfetch.compat import httplib
+
+
+# how many connections each host gets, both in use and kept idle
+CONNS_PER_HOST = 4
+if os.environ.get("CONNS_PER_HOST"):
+    CONNS_PER_HOST = int(os.environ.get("CONNS_PER_HOST"))
+
+# seconds an idle connection is kept before it's closed
+IDLE_TIMEOUT = 30
+
+# ftp logins kept idle at most, over all hosts
+FTP_CONNS = 10
+
+
+class ConnectionPool(object):
+    """Keeps http connections alive between requests, keyed by scheme, host
+    and port, so that a crawl of one host doesn't pay for a tcp connect and
+    tls handshake on every page. Shared by all fetchers and thread safe."""
+
+    def __init__(self, conns_per_host=CONNS_PER_HOST, idle_timeout=IDLE_TIMEOUT):
+        self.conns_per_host = conns_per_host
+        self.idle_timeout = idle_timeout
+
+        self.idle = {}  # key -> list of (conn, time released)
+        self.busy = {}  # key -> number of connections handed out
+        self.cond = threading.Condition()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, scheme, host):
+        (host, _, port) = host.partition(':')
+        if not port:
+            port = (scheme == "https" and httplib.HTTPS_PORT) or httplib.HTTP_PORT
+        return scheme, host.lower(), int(port)
+
+    def get(self, scheme, host):
+        """Returns a connection to host, reusing an idle one if possible. Blocks
+        while the host has conns_per_host connections in use."""
+        key = self.get_key(scheme, host)
+        with self.cond:
+            while 0 < self.conns_per_host <= self.busy.get(key, 0):
+                self.cond.wait()
+            self.busy[key] = self.busy.get(key, 0) + 1
+
+            self.evict()
+            if self.idle.get(key):
+                (conn, _) = self.idle[key].pop()
+                conn.reused = True
+                self.hits += 1
+                return conn
+            self.misses += 1
+
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host)
+        else:
+            conn = httplib.HTTPConnection(host)
+        conn.pool_key = key
+        conn.reused = False
+        return conn
+
+    def put(self, conn):
+        """Hand back a connection whose response has been read in full"""
+        key = conn.pool_key
+        with self.cond:
+            self.busy[key] -= 1
+            self.cond.notify_all()
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.conns_per_host:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        """Hand back a connection that can't be reused"""
+        with self.cond:
+            self.busy[conn.pool_key] -= 1
+            self.cond.notify_all()
+        conn.close()
+
+    def release(self, conn, response):
+        """Hand back a connection after reading response in full"""
+        if response.will_close:
+            self.discard(conn)
+        else:
+            self.put(conn)
+
+    def evict(self):
+        """Close connections that have been idle too long, the server has
+        probably dropped them already"""
+        cutoff = time.time() - self.idle_timeout
+        for key in list(self.idle.keys()):
+            keep = []
+            for (conn, t) in self.idle[key]:
+                if t < cutoff:
+                    conn.close()
+                else:
+                    keep.append((conn, t))
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+
+    def stats(self):
+        return "%s hits, %s misses" % (self.hits, self.misses)
+
+pool = ConnectionPool()
+
+
+class FtpPool(object):
+    """Keeps ftp control connections logged in between transfers, keyed by
+    user, host, port and directory, so that fetching a directory full of
+    files logs in once. A connection is handed out to one transfer at a time,
+    the least recently used idle ones are closed once there are more than
+    maxconns."""
+
+    def __init__(self, maxconns=FTP_CONNS, idle_timeout=IDLE_TIMEOUT):
+        self.maxconns = maxconns
+        self.idle_timeout = idle_timeout
+
+        self.idle = []  # (key, conn, time released), least recently used first
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, connect):
+        """Returns an idle connection for key, or a new one from connect()"""
+        with self.lock:
+            self.evict()
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i][0] == key:
+                    (_, conn, _) = self.idle.pop(i)
+                    self.hits += 1
+                    return conn
+            self.misses += 1
+        conn = connect()
+        conn.pool_key = key
+        return conn
+
+    def put(self, conn):
+        """Hand back a connection once its transfer is over"""
+        with self.lock:
+            self.idle.append((conn.pool_key, conn, time.time()))
+            self.evict()
+
+    def discard(self, conn):
+        conn.close()
+
+    def evict(self):
+        cutoff = time.time() - self.idle_timeout
+        keep = []
+        for (key, conn, t) in self.idle:
+            if t < cutoff:
+                conn.close()
+            else:
+                keep.append((key, conn, t))
+        while len(keep) > self.maxconns:
+            keep.pop(0)[1].close()
+        self.idle = keep
+
+    def stats(self):
+        return "%s hits, %s misses" % (self.hits, self.misses)
+
+ftp_pool = FtpPool()
+
+
+def testsuite():
+    """Make requests to a local server through a pool"""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    host = "127.0.0.1:%s" % server.server_address[1]
+
+    def request(pool):
+        conn = pool.get("http", host)
+        conn.request("GET", "/")
+        response = conn.getresponse()
+        body = response.read()
+        pool.release(conn, response)
+        return conn, body
+
+    checks = []
+    try:
+        pool = ConnectionPool(conns_per_host=1)
+        (first, body) = request(pool)
+        (second, _) = request(pool)
+        checks.append(("response read", body == b"ok"))
+        checks.append(("connection reused", second is first and second.reused))
+
+        # the host's one connection is taken, the next get waits for it
+        conn = pool.get("http", host)
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.get("http", host)))
+        waiter.daemon = True
+        waiter.start()
+        waiter.join(0.2)
+        checks.append(("get blocks at conns_per_host", not got))
+        pool.put(conn)
+        waiter.join(1)
+        checks.append(("and returns once one is put back", got == [conn]))
+        pool.discard(conn)
+
+        pool = ConnectionPool(idle_timeout=0)
+        (first, _) = request(pool)
+        (second, _) = request(pool)
+        checks.append(("idle connections evicted", second is not first))
+        pool.evict()
+    finally:
+        server.shutdown()
+    for (name, ok) in checks:
+        print("%s: %s" % (name, ok))
+    return all([ok for (_, ok) in checks])
+
+
+
+if __name__ == "__main__":
+    sys.exit(not testsuite())
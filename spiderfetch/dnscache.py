@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import socket
+import sys
+import threading
+import time
+
+from spiderfetch import ioutils
+from spiderfetch.compat import queue
+from spiderfetch.compat import urlparse
+
+
+# seconds to keep an address, and to remember that a host doesn't exist
+DNS_TTL = 300
+NEGATIVE_TTL = 60
+
+# entries kept at most, and threads resolving hosts ahead of time
+MAX_ENTRIES = 10000
+PREFETCH_THREADS = 4
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21}
+
+
+class DnsCache(object):
+    """Remembers the answers of getaddrinfo for ttl seconds, failed lookups
+    too, for negative_ttl seconds. Lookups of the same host at the same time
+    wait for a single query. The resolver doesn't tell us the ttl of the
+    records, so it's the same for all of them."""
+
+    def __init__(self, ttl=DNS_TTL, negative_ttl=NEGATIVE_TTL, resolver=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.resolver = resolver or socket.getaddrinfo
+        self.lock = threading.Lock()
+
+        self.entries = {}   # key -> (expires, result, error)
+        self.pending = {}   # key -> event set when the lookup is done
+
+        self.prefetch_queue = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, host, family=0, type=0, proto=0, flags=0):
+        if isinstance(host, bytes):
+            host = host.decode('idna')
+        return ((host or "").lower(), family, type, proto, flags)
+
+    def set_port(self, result, port):
+        return [(family, type, proto, canonname, (sockaddr[0], port) + sockaddr[2:])
+                for (family, type, proto, canonname, sockaddr) in result]
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        """Drop-in replacement for socket.getaddrinfo"""
+        # the answer is the same for every port, ftp data connections alone
+        # use a new one every time
+        try:
+            port = int(port or 0)
+        except ValueError:
+            return self.resolver(host, port, family, type, proto, flags)
+        key = self.get_key(host, family, type, proto, flags)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry[0] > time.time():
+                    self.hits += 1
+                    (_, result, error) = entry
+                    if error:
+                        raise error
+                    return self.set_port(result, port)
+                event = self.pending.get(key)
+                if not event:
+                    self.misses += 1
+                    event = self.pending[key] = threading.Event()
+                    break
+            # someone else is looking it up already
+            event.wait()
+
+        try:
+            result = self.resolver(host, port, family, type, proto, flags)
+            self.store(key, result, None, self.ttl)
+            return self.set_port(result, port)
+        except socket.gaierror as e:
+            # a temporary failure says nothing about the host
+            if not e.args[0] == socket.EAI_AGAIN:
+                self.store(key, None, e, self.negative_ttl)
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+    def store(self, key, result, error, ttl):
+        with self.lock:
+            if len(self.entries) >= MAX_ENTRIES:
+                self.evict()
+            self.entries[key] = (time.time() + ttl, result, error)
+
+    def evict(self):
+        t = time.time()
+        for (key, entry) in list(self.entries.items()):
+            if entry[0] <= t:
+                del self.entries[key]
+        # still full, drop the ones closest to expiring
+        if len(self.entries) >= MAX_ENTRIES:
+            keys = sorted(self.entries, key=lambda k: self.entries[k][0])
+            for key in keys[:len(keys) // 2]:
+                del self.entries[key]
+
+    def gethostbyname(self, host, port=0):
+        """Drop-in replacement for socket.gethostbyname"""
+        addrs = self.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        for (family, _, _, _, sockaddr) in addrs:
+            if family == socket.AF_INET:
+                return sockaddr[0]
+        raise socket.gaierror(socket.EAI_FAMILY, "No IPv4 address for %s" % host)
+
+    def prefetch(self, url):
+        """Look up the host of url in the background, if we haven't already"""
+        pack = urlparse.urlsplit(url)
+        port = pack.port or DEFAULT_PORTS.get(pack.scheme)
+        if not pack.hostname or not port:
+            return
+        key = self.get_key(pack.hostname, 0, socket.SOCK_STREAM)
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry and entry[0] > time.time()) or key in self.pending:
+                return
+            if self.prefetch_queue is None:
+                self.prefetch_queue = queue.Queue()
+                for _ in range(PREFETCH_THREADS):
+                    t = threading.Thread(target=self.prefetch_worker)
+                    t.daemon = True
+                    t.start()
+        self.prefetch_queue.put((pack.hostname, port))
+
+    def prefetch_worker(self):
+        while True:
+            (host, port) = self.prefetch_queue.get()
+            try:
+                self.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            except socket.error:
+                pass
+
+    def stats(self):
+        return "%s hits, %s misses" % (self.hits, self.misses)
+
+cache = None
+_install_lock = threading.Lock()
+
+def install():
+    """Route all lookups in the process through the cache, unless $DNS_TTL
+    is 0. Returns the cache, or None if it's disabled."""
+    global cache
+    ttl = os.environ.get("DNS_TTL")
+    if ttl and not int(ttl):
+        return None
+    with _install_lock:
+        if cache is None:
+            cache = DnsCache(ttl=int(ttl or DNS_TTL))
+            socket.getaddrinfo = cache.getaddrinfo
+    return cache
+
+def gethostbyname(host, port=0):
+    if cache:
+        return cache.gethostbyname(host, port)
+    return socket.gethostbyname(host)
+
+def prefetch(url):
+    if cache:
+        cache.prefetch(url)
+
+
+
+if __name__ == "__main__":
+    (parser, a) = ioutils.init_opts("<host>+")
+    (opts, args) = ioutils.parse_args(parser)
+    if not args:
+        ioutils.opts_help(None, None, None, parser)
+    dns = install()
+    for _ in range(2):
+        for host in args:
+            t = time.time()
+            try:
+                addr = dns.gethostbyname(host)
+            except socket.error as e:
+                addr = "error: %s" % e
+            print("%s  %s  %.1fms" % (host.ljust(30), addr, (time.time() - t) * 1000))
+    sys.stderr.write("DNS cache: %s\n" % dns.stats())
@@ -3,22 +3,40 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import email
 import ftplib
+import hashlib
 import os
 import re
 import socket
 import sys
+import threading
 import time
 import urllib
+import zlib
 
 import ansicolor
 
+from spiderfetch import connpool
+from spiderfetch import dnscache
 from spiderfetch import filetype
+from spiderfetch import httpcache
 from spiderfetch import ioutils
+from spiderfetch import manifest
+from spiderfetch import ratelimit
+from spiderfetch import retry
+from spiderfetch import spider
 from spiderfetch import urlrewrite
+from spiderfetch.compat import BaseHTTPRequestHandler
 from spiderfetch.compat import ContentTooShortError
 from spiderfetch.compat import FancyURLopener
+from spiderfetch.compat import addclosehook
+from spiderfetch.compat import addinfourl
+from spiderfetch.compat import ftperrors
 from spiderfetch.compat import ftpwrapper
+from spiderfetch.compat import HTTPServer
+from spiderfetch.compat import httplib
+from spiderfetch.compat import sslerror
 from spiderfetch.compat import unwrap
 from spiderfetch.compat import urlparse
 
@@ -47,8 +65,22 @@ os.environ["LOGGING"] = str(True)
 
 CHECKSUM_SIZE = 10 * 1024
 
+# keep http connections alive in connpool.pool, needs the python 3 urllib
+_pooled = (connpool.CONNS_PER_HOST > 0 and
+           hasattr(FancyURLopener, "_open_generic_http"))
+
 RETRY_WAIT = 10
 
+# don't split downloads into byte ranges smaller than this
+SEGMENT_MIN_SIZE = 1024 * 1024
+
+# bytes asked for per read, doubling while reads fill the buffer
+CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# seconds between progress reports
+REPORT_INTERVAL = 0.25
+
 class ErrorAlreadyProcessed(Exception):
     pass
 
@@ -67,10 +99,64 @@ class ResumeChecksumFailed(Exception):
 class ResumeNotSupported(Exception):
     pass
 
+class NotModified(Exception):
+    pass
+
 class ChangedUrlWarning(Exception):
     def __init__(self, new_url):
         self.new_url = new_url
 
+class ContentDecoder(object):
+    """Undoes a gzip or deflate Content-Encoding a block at a time, without
+    letting any one piece of output grow past max_length"""
+    max_length = 64 * 1024
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.started = False
+        self.head = b""
+        if encoding == "gzip":
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.obj = zlib.decompressobj()
+
+    def decode(self, block):
+        if not self.started and self.encoding == "deflate":
+            # some servers send raw deflate data without the zlib header,
+            # it takes the first two bytes to tell
+            self.head += block
+            if len(self.head) < 2:
+                return []
+            (block, self.head) = (self.head, b"")
+            self.started = True
+            try:
+                return list(self.inner_decode(block))
+            except zlib.error:
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.started = True
+        return self.inner_decode(block)
+
+    def inner_decode(self, block):
+        data = self.obj.decompress(block, self.max_length)
+        while data:
+            yield data
+            data = self.obj.decompress(self.obj.unconsumed_tail, self.max_length)
+
+    def flush(self):
+        (head, self.head) = (self.head, b"")
+        for data in self.inner_decode(head):
+            yield data
+        data = self.obj.flush()
+        if data:
+            yield data
+
+def get_decoder(headers):
+    encoding = (headers.get("content-encoding") or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        return ContentDecoder("gzip")
+    if encoding == "deflate":
+        return ContentDecoder("deflate")
+
 class err(object):
     def __init__(self):
         self.dns = 1
@@ -85,8 +171,10 @@ class err(object):
         self.redirect = 10
         self.checksum = 11
         self.no_resume = 12
+        self.host_down = 13
 
-        self.temporal = [self.timeout, self.socket, self.url_error, self.http_503]
+        self.temporal = [self.timeout, self.socket, self.url_error, self.http_503,
+                         self.host_down]
 
     def __getattr__(self, att):
         """Disclaimer: Hackish
@@ -156,17 +244,34 @@ class Myftpwrapper(ftpwrapper):
             conn = self.ftp.ntransfercmd(cmd)
         self.busy = 1
         # Pass back both a suitably decorated object and a retrieval length
-        return (urllib.addclosehook(conn[0].makefile('rb'),
-                                    self.endtransfer), conn[1])
+        return (addclosehook(conn[0].makefile('rb'), self.release), conn[1])
+
+    def release(self):
+        """Finish the transfer and give the login back to the pool"""
+        self.endtransfer()
+        connpool.ftp_pool.put(self)
 
 class MyURLopener(FancyURLopener):
     checksum_size = CHECKSUM_SIZE
     version = _user_agent
 
+    # headers that only hold for the url they were worked out for
+    request_headers = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+
     def __init__(self, fetcher):
         FancyURLopener.__init__(self)
         self.fetcher = fetcher
 
+        # offset to resume ftp transfers from, read in open_ftp()
+        self.rest = None
+
+        # connection from the pool the current http request is on
+        self._scheme = None
+        self._conn = None
+        self._response = None
+        if _pooled:
+            self.set_header(('Connection', 'keep-alive'))
+
     def prompt_user_passwd(self, host, realm):
         """Don't prompt for credentials"""
         return None, None
@@ -179,6 +284,10 @@ class MyURLopener(FancyURLopener):
         self.fetcher.handle_error(eval('err.http_' + str(errcode)))
         raise ErrorAlreadyProcessed
 
+    def http_error_304(self, url, fp, errcode, errmsg, headers, data=None):
+        """Only happens if we sent validators from the cache"""
+        raise NotModified
+
     def redirect_internal(self, url, fp, errcode, errmsg, headers, data):
         if os.environ.get("SILENT_REDIRECT"):
             return urllib.FancyURLopener.redirect_internal(
@@ -192,6 +301,48 @@ class MyURLopener(FancyURLopener):
         newurl = urlparse.urljoin(self.fetcher.url, newurl)
         raise ChangedUrlWarning(newurl)
 
+    def get_conn(self, host):
+        self._conn = connpool.pool.get(self._scheme, host)
+        return self._conn
+
+    def release_conn(self, reuse=False):
+        """Give the connection back to the pool, it's only reused if the
+        response has been read in full"""
+        (conn, self._conn) = (self._conn, None)
+        (response, self._response) = (self._response, None)
+        if conn:
+            if reuse and response and not response.will_close:
+                connpool.pool.put(conn)
+            else:
+                connpool.pool.discard(conn)
+
+    def open_pooled(self, scheme, url, data):
+        """Like open_http, but on a connection from the pool"""
+        self.release_conn()
+        self._scheme = scheme
+        while True:
+            try:
+                fp = self._open_generic_http(self.get_conn, url, data)
+                break
+            except IOError:
+                reused = self._conn and self._conn.reused
+                self.release_conn()
+                # the server may have dropped an idle connection, try another
+                if not reused:
+                    raise
+        self._response = fp.fp
+        return fp
+
+    def open_http(self, url, data=None):
+        if not _pooled:
+            return FancyURLopener.open_http(self, url, data)
+        return self.open_pooled("http", url, data)
+
+    def open_https(self, url, data=None):
+        if not _pooled:
+            return FancyURLopener.open_https(self, url, data)
+        return self.open_pooled("https", url, data)
+
     def set_header(self, pair):
         (key, value) = pair
         found = False
@@ -202,6 +353,16 @@ class MyURLopener(FancyURLopener):
         if not found:
             self.addheaders.append(pair)
 
+    def get_decoder(self, headers):
+        """Only undo an encoding we asked for. A file like foo.tar.gz is
+        often served with Content-Encoding: gzip, and is saved as it is."""
+        if 'Accept-Encoding' in dict(self.addheaders):
+            return get_decoder(headers)
+
+    def clear_request_headers(self):
+        self.addheaders = [(k, v) for (k, v) in self.addheaders
+                           if k not in self.request_headers]
+
     def continue_file(self, filename):
         localsize = os.path.getsize(filename)
         if localsize < self.checksum_size:
@@ -209,17 +370,58 @@ class MyURLopener(FancyURLopener):
         seekto = localsize - self.checksum_size
 
         # set var read in open_ftp()
-        os.environ["REST"] = str(seekto)
+        self.rest = str(seekto)
 
         # set header for http
         self.set_header(('Range', 'bytes=%s-' % seekto))
 
         return localsize
 
+    def continue_manifest(self, url, filename):
+        """Resume exactly where the manifest of filename says the download
+        stopped, if it checks out. Returns (manifest, bytes to keep)."""
+        state = manifest.Manifest.load(filename, url)
+        localsize = state and state.verify()
+        if not localsize:
+            return None, 0
+
+        self.rest = str(localsize)
+        self.set_header(('Range', 'bytes=%s-' % localsize))
+        self.set_header(('If-Range', state.get_validator()))
+        return state, localsize
+
+    def resumes_at(self, headers, offset, state):
+        """Whether the response continues the download in state at offset"""
+        if not self.fetcher.proto == self.fetcher.PROTO_HTTP:
+            return True
+        m = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', headers.get("content-range") or "")
+        if not m or not int(m.group(1)) == offset:
+            return False
+        return state.size < 0 or m.group(2) == "*" or int(m.group(2)) == state.size
+
+    def keeps_manifest(self, filename):
+        """Downloads to files get a manifest, pages being spidered don't"""
+        return (isinstance(filename, str) and
+                not self.fetcher.mode == self.fetcher.SPIDER)
+
+    def restore_cached(self, cache, url, filename, reporthook=None, datahook=None):
+        """The server says our copy of url is current, use that"""
+        headers = cache.restore(url, filename)
+        self.fetcher.content_type = headers.get("content-type")
+        if reporthook:
+            reporthook(0, 1, ioutils.get_size(filename))
+        if datahook:
+            tfp = ioutils.open_file(filename, 'rb')
+            datahook(tfp.read())
+            ioutils.close_file(tfp, filename)
+        return filename, headers
+
     # Override function from urllib to support resuming transfers
-    def retrieve(self, url, filename, reporthook=None, data=None, cont=None):
+    def retrieve(self, url, filename, reporthook=None, data=None, cont=None,
+                 datahook=None):
         """retrieve(url) returns (filename, headers) for a local object
-        or (tempfilename, headers) for a remote object."""
+        or (tempfilename, headers) for a remote object. datahook gets every
+        block of data as it arrives."""
         url = unwrap(url)
         if self.tempcache and url in self.tempcache:
             return self.tempcache[url]
@@ -234,20 +436,42 @@ class MyURLopener(FancyURLopener):
                 return urllib.url2pathname(urllib.splithost(url1)[1]), hdrs
             except IOError:
                 pass
-        bs = 1024 * 8
         size = -1
         read = 0
-        blocknum = 0
+        state = None
         if cont:
-            localsize = self.continue_file(filename)
+            (state, localsize) = self.continue_manifest(url, filename)
+            if not state:
+                localsize = self.continue_file(filename)
             read = localsize
-            blocknum = localsize / bs
-        fp = self.open(url, data)
+
+        # revalidate pages we have seen before
+        cache = httpcache.get_cache()
+        if cont or not self.fetcher.mode == self.fetcher.SPIDER:
+            cache = None
+        if cache:
+            for pair in cache.validators(url):
+                self.set_header(pair)
+
+        try:
+            fp = self.open(url, data)
+        except NotModified:
+            return self.restore_cached(cache, url, filename, reporthook, datahook)
         headers = fp.info()
-        if cont:
+        # only trust the content type when it comes from the server
+        if self.fetcher.proto == self.fetcher.PROTO_HTTP:
+            self.fetcher.content_type = headers.get("content-type")
+            self.fetcher.check_content_type()
+        if state and not self.resumes_at(headers, localsize, state):
+            # the file has changed on the server, start over
+            (cont, state, read) = (False, None, 0)
+        if cont and state:
+            tfp = open(filename, 'rb+')
+            tfp.seek(localsize)
+            tfp.truncate()
+        elif cont:
             if (self.fetcher.proto == self.fetcher.PROTO_HTTP and
-                not (headers.dict.get("content-range") or
-                     headers.dict.get("Content-Range"))):
+                not headers.get("content-range")):
                 raise ResumeNotSupported
             tfp = open(filename, 'rb+')
             tfp.seek(-self.checksum_size, os.SEEK_END)
@@ -256,7 +480,7 @@ class MyURLopener(FancyURLopener):
             if not local == remote:
                 raise ResumeChecksumFailed
         else:
-            tfp = open(filename, 'wb')
+            tfp = ioutils.open_file(filename, 'wb')
         result = filename, headers
         if self.tempcache is not None:
             self.tempcache[url] = result
@@ -264,19 +488,70 @@ class MyURLopener(FancyURLopener):
             if "content-length" in headers:
                 size = int(headers["Content-Length"])
                 if cont and self.fetcher.proto == self.fetcher.PROTO_HTTP:
-                    size = size + localsize - self.checksum_size
-            reporthook(blocknum, bs, size)
-        while 1:
-            block = fp.read(bs)
-            if not block:
-                break
-            read += len(block)
-            tfp.write(block)
-            blocknum += 1
+                    size = size + localsize
+                    if not state:
+                        size -= self.checksum_size
+            reporthook(read, 1, size)
+        if self.keeps_manifest(filename):
+            state = state or manifest.Manifest(filename, url)
+            state.start(headers, read)
+            # the manifest says how much of the file is good, so the rest can
+            # be reserved up front, if the download can be resumed by it
+            if state.size > read and state.get_validator():
+                ioutils.preallocate(tfp, state.size)
+        decoder = self.get_decoder(headers)
+        host = urlrewrite.get_hostname(url)
+
+        # read into the same buffer every time where the file object allows,
+        # whatever is done with a block has to copy it
+        chunk = CHUNK_SIZE
+        buf = memoryview(bytearray(MAX_CHUNK_SIZE))
+        readinto = getattr(fp, "readinto", None)
+        reported = time.time()
+        try:
+            while 1:
+                if readinto:
+                    n = readinto(buf[:chunk])
+                    block = buf[:n]
+                else:
+                    block = fp.read(chunk)
+                    n = len(block)
+                if not n:
+                    break
+                if n == chunk:
+                    chunk = min(chunk * 2, MAX_CHUNK_SIZE)
+                read += n
+                ratelimit.limiter.throttle(host, n)
+                blocks = [block]
+                if decoder:
+                    blocks = decoder.decode(block)
+                for data in blocks:
+                    tfp.write(data)
+                    if state:
+                        state.update(data, tfp)
+                    if datahook:
+                        datahook(data)
+                if reporthook and time.time() - reported >= REPORT_INTERVAL:
+                    reported = time.time()
+                    reporthook(read, 1, size)
+            if decoder:
+                for data in decoder.flush():
+                    tfp.write(data)
+                    if state:
+                        state.update(data, tfp)
+                    if datahook:
+                        datahook(data)
+                self.fetcher.wire_size = read
             if reporthook:
-                reporthook(blocknum, bs, size)
+                reporthook(read, 1, size)
+        finally:
+            # drop what was reserved and not written, so a failed download
+            # doesn't leave a file of the full size
+            if state and state.size > tfp.tell():
+                tfp.truncate()
+        self.release_conn(reuse=True)
         fp.close()
-        tfp.close()
+        ioutils.close_file(tfp, filename)
         del fp
         del tfp
 
@@ -285,39 +560,206 @@ class MyURLopener(FancyURLopener):
             raise ContentTooShortError("retrieval incomplete: got only %i out "
                                        "of %i bytes" % (read, size), result)
 
+        if state:
+            state.remove()
+        if cache:
+            cache.store(url, headers, filename)
+
         return result
 
+    def request_pooled(self, method, url, headers=None):
+        """Make a request on a connection from the pool, returns (conn, response)"""
+        pack = urlparse.urlsplit(url)
+        selector = urlparse.urlunsplit(('', '', pack.path or '/', pack.query, ''))
+        hdrs = dict(self.addheaders)
+        hdrs.update(headers or {})
+        conn = connpool.pool.get(pack.scheme, pack.netloc)
+        try:
+            conn.request(method, selector, headers=hdrs)
+            return conn, conn.getresponse()
+        except (socket.error, httplib.HTTPException) as e:
+            connpool.pool.discard(conn)
+            raise IOError('socket error', e)
+
+    def same_version(self, headers, other):
+        """Whether two responses are for the same version of a file, by the
+        validators both of them have"""
+        for k in ("etag", "last-modified"):
+            if headers.get(k) and other.get(k) and not headers.get(k) == other.get(k):
+                return False
+        return True
+
+    def retrieve_segmented(self, url, filename, reporthook=None, segments=2):
+        """Download url as byte ranges on parallel connections straight into
+        their place in a preallocated file. Falls back on retrieve() when the
+        server doesn't do ranges or the file is too small to bother. If a
+        range doesn't come back as asked, or from the same version of the
+        file, the download starts over on one connection. If one fails, what
+        came before it is recorded in a manifest and the rest is resumed on
+        one connection."""
+        pack = urlparse.urlsplit(url)
+        if pack.username or pack.scheme not in ("http", "https"):
+            return self.retrieve(url, filename, reporthook=reporthook)
+
+        (conn, response) = self.request_pooled("HEAD", url)
+        response.read()
+        connpool.pool.release(conn, response)
+        headers = response.msg
+        size = int(headers.get("content-length") or -1)
+        segments = min(segments, size // SEGMENT_MIN_SIZE)
+        # there's no point in more ranges than connections we may open
+        if connpool.pool.conns_per_host:
+            segments = min(segments, connpool.pool.conns_per_host)
+        if (not response.status == 200 or segments < 2 or
+                not headers.get("accept-ranges", "").lower() == "bytes"):
+            return self.retrieve(url, filename, reporthook=reporthook)
+
+        # make sure every range comes from the same version of the file
+        validator = headers.get("etag") or headers.get("last-modified")
+        range_headers = {}
+        if validator:
+            range_headers["If-Range"] = validator
+
+        tfp = open(filename, 'wb')
+        tfp.truncate(size)
+        ioutils.preallocate(tfp, size)
+        tfp.close()
+        # nothing is recorded until the ranges are in, but a later run finds
+        # the manifest and doesn't take the file for a complete one
+        state = manifest.Manifest(filename, url)
+        state.start(headers)
+
+        host = urlrewrite.get_hostname(url)
+        lock = threading.Lock()
+        stop = threading.Event()
+        progress = {"read": 0, "reported": time.time()}
+        errors = []
+
+        step = size // segments
+        ranges = []
+        for i in range(segments):
+            start = i * step
+            end = start + step - 1
+            if i == segments - 1:
+                end = size - 1
+            ranges.append((start, end))
+        done = [0] * segments
+
+        def fetch_range(i, start, end):
+            tfp = open(filename, 'rb+')
+            tfp.seek(start)
+            read = 0
+            chunk = CHUNK_SIZE
+            buf = memoryview(bytearray(MAX_CHUNK_SIZE))
+            conn = None
+            try:
+                h = {"Range": "bytes=%s-%s" % (start, end)}
+                h.update(range_headers)
+                (conn, fp) = self.request_pooled("GET", url, h)
+                content_range = fp.getheader("content-range") or ""
+                if (not fp.status == 206 or
+                        not content_range.startswith("bytes %s-%s/" % (start, end))):
+                    raise ResumeNotSupported
+                if not self.same_version(headers, fp.msg):
+                    raise ResumeChecksumFailed
+                while read <= end - start and not stop.is_set():
+                    want = min(chunk, end - start + 1 - read)
+                    n = fp.readinto(buf[:want])
+                    if not n:
+                        break
+                    if n == chunk:
+                        chunk = min(chunk * 2, MAX_CHUNK_SIZE)
+                    tfp.write(buf[:n])
+                    read += n
+                    ratelimit.limiter.throttle(host, n)
+                    with lock:
+                        done[i] = read
+                        progress["read"] += n
+                        if (reporthook and
+                                time.time() - progress["reported"] >= REPORT_INTERVAL):
+                            progress["reported"] = time.time()
+                            reporthook(progress["read"], 1, size)
+                if read < end - start + 1:
+                    raise ContentTooShortError("segment incomplete: got only %i out "
+                                               "of %i bytes" % (read, end - start + 1),
+                                               (filename, headers))
+                connpool.pool.put(conn)
+                conn = None
+            except Exception as e:
+                errors.append(e)
+                # the rest is fetched on one connection either way
+                stop.set()
+            finally:
+                if conn:
+                    connpool.pool.discard(conn)
+                tfp.close()
+
+        def settle():
+            """Keep what came in before the first range that's missing
+            something, returns how much that is"""
+            stop.set()
+            with lock:
+                for (i, (start, end)) in enumerate(ranges):
+                    offset = start + done[i]
+                    if offset <= end:
+                        break
+            tfp = open(filename, 'rb+')
+            tfp.truncate(offset)
+            tfp.close()
+            state.record_to(offset)
+            return offset
+
+        if reporthook:
+            reporthook(0, 1, size)
+        threads = []
+        for (i, (start, end)) in enumerate(ranges):
+            t = threading.Thread(target=fetch_range, args=(i, start, end))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+        except KeyboardInterrupt:
+            settle()
+            raise
+
+        if reporthook:
+            reporthook(progress["read"], 1, size)
+        if not errors:
+            state.remove()
+            return filename, headers
+
+        # a range the server wouldn't give, or of another version of the
+        # file, means none of them can be trusted
+        if [e for e in errors if isinstance(e, (ResumeNotSupported, ResumeChecksumFailed))]:
+            state.remove()
+            return self.retrieve(url, filename, reporthook=reporthook)
+        settle()
+        return self.retrieve(url, filename, reporthook=reporthook,
+                             cont=bool(state.verify()))
+
     # Override function from urllib to use custom frpwrapper
     def open_ftp(self, url):
         """Use FTP protocol."""
         if not isinstance(url, str):
             raise IOError(('ftp error', 'proxy support for ftp protocol currently not implemented'))
         import mimetypes
-        import mimetools
-        try:
-            from cStringIO import StringIO
-        except ImportError:
-            from StringIO import StringIO
-        host, path = urllib.splithost(url)
-        if not host:
+        pack = urlparse.urlsplit("ftp:" + url)
+        if not pack.hostname:
             raise IOError(('ftp error', 'no host given'))
-        host, port = urllib.splitport(host)
-        user, host = urllib.splituser(host)
-        if user:
-            user, passwd = urllib.splitpasswd(user)
-        else:
-            passwd = None
-        host = urllib.unquote(host)
-        user = urllib.unquote(user or '')
-        passwd = urllib.unquote(passwd or '')
-        host = socket.gethostbyname(host)
+        user = urlparse.unquote(pack.username or '')
+        passwd = urlparse.unquote(pack.password or '')
+        host = urlparse.unquote(pack.hostname)
+        port = pack.port
         if not port:
             import ftplib  # noqa
             port = ftplib.FTP_PORT
-        else:
-            port = int(port)
-        path, attrs = urllib.splitattr(path)
-        path = urllib.unquote(path)
+        host = dnscache.gethostbyname(host, port)
+        attrs = pack.path.split(';')
+        (path, attrs) = (attrs[0], attrs[1:])
+        path = urlparse.unquote(path)
         dirs = path.split('/')
         dirs, file = dirs[:-1], dirs[-1]
         if dirs and not dirs[0]:
@@ -325,38 +767,33 @@ class MyURLopener(FancyURLopener):
         if dirs and not dirs[0]:
             dirs[0] = '/'
         key = user, host, port, '/'.join(dirs)
-        # XXX thread unsafe!
-        if len(self.ftpcache) > urllib.MAXFTPCACHE:
-            # Prune the cache, rather arbitrarily
-            for k in self.ftpcache.keys():
-                if k != key:
-                    v = self.ftpcache[k]
-                    del self.ftpcache[k]
-                    v.close()
         try:
-            if not key in self.ftpcache:
-                self.ftpcache[key] = \
-                    Myftpwrapper(user, passwd, host, port, dirs)
+            # logins are shared by all fetchers, see connpool.FtpPool
+            conn = connpool.ftp_pool.get(
+                key, lambda: Myftpwrapper(user, passwd, host, port, dirs, timeout))
             if not file:
                 type = 'D'
             else:
                 type = 'I'
             for attr in attrs:
-                attr, value = urllib.splitvalue(attr)
+                attr, _, value = attr.partition('=')
                 if attr.lower() == 'type' and \
                    value in ('a', 'A', 'i', 'I', 'd', 'D'):
                     type = value.upper()
-            (fp, retrlen) = self.ftpcache[key].retrfile(file, type,
-                                                        rest=os.environ.get("REST"))
+            try:
+                (fp, retrlen) = conn.retrfile(file, type, rest=self.rest)
+            except Exception:
+                connpool.ftp_pool.discard(conn)
+                raise
             mtype = mimetypes.guess_type("ftp:" + url)[0]
             headers = ""
             if mtype:
                 headers += "Content-Type: %s\n" % mtype
             if retrlen is not None and retrlen >= 0:
                 headers += "Content-Length: %d\n" % retrlen
-            headers = mimetools.Message(StringIO(headers))
-            return urllib.addinfourl(fp, headers, "ftp:" + url)
-        except urllib.ftperrors() as msg:
+            headers = email.message_from_string(headers)
+            return addinfourl(fp, headers, "ftp:" + url)
+        except ftperrors() as msg:
             raise IOError(('ftp error', msg), sys.exc_info()[2])
 
 class Fetcher(object):
@@ -374,7 +811,8 @@ class Fetcher(object):
     urlwidth = linewidth - actionwidth - ratewidth - sizewidth - 7  # 7 for spaces
     units = {0: "B", 1: "KB", 2: "MB", 3: "GB", 4: "TB", 5: "PB", 6: "EB"}
 
-    def __init__(self, mode=FETCH, url=None, filename=None):
+    def __init__(self, mode=FETCH, url=None, filename=None, fileobj=None):
+        dnscache.install()
         self._opener = MyURLopener(self)
         urllib._urlopener = self._opener
 
@@ -386,6 +824,8 @@ class Fetcher(object):
             self.is_typechecked = True
         elif mode == self.SPIDER:
             self.action = "spider"
+            # pages compress well, retrieve() decodes them on the fly
+            self._opener.set_header(('Accept-Encoding', 'gzip, deflate'))
         elif mode == self.SPIDER_FETCH:
             self.action = "spider"
             self.fetch_if_wrongtype = True
@@ -394,14 +834,36 @@ class Fetcher(object):
         if os.environ.get("TRIES"):
             self.tries = int(os.environ.get("TRIES"))
         self.retry_wait = RETRY_WAIT
+        self.attempts = 0
 
         self.proto = None
         self.url = url
         self.filename = filename
+        # download into this file object instead, if given
+        self.fileobj = fileobj
+
+        # a spider.Extractor to find urls as the document downloads
+        self.extractor = None
+        # or the urls found by a parsepool.ParsePool, already rewritten
+        self.urls = None
+
+        # a filetype.Prober to classify urls before fetching them
+        self.prober = None
+
+        # the start of the document, kept in memory for type checks
+        self.header = bytearray()
+        self.content_type = None
+        self.typechecks = {}
 
         self.timestamp = None
         self.download_size = None
         self.totalsize = None
+        # bytes that came over the wire and after decoding, if they differ
+        self.wire_size = None
+        self.decoded_size = 0
+
+        # sha1 of the body as it comes in, see content_hash
+        self.hasher = None
 
         self.started = False
         self.error = None
@@ -464,6 +926,8 @@ class Fetcher(object):
             rate = ("%s" % self.retry_wait) + "s..."
         elif complete:
             rate = "done"
+            if self.wire_size and self.decoded_size > self.wire_size:
+                rate = "done %.1fx" % (float(self.decoded_size) / self.wire_size)
         else:
             rate = "%s/s" % self.format_size(rate)
         rate = rate.ljust(self.ratewidth)
@@ -509,21 +973,67 @@ class Fetcher(object):
         elif complete:
             self.log_url("done")
 
-    def typecheck_html(self, filename):
+    def memoized(self, check, *args):
+        """Run a type check on the header, unless it hasn't grown since the
+        last time"""
+        (length, result) = self.typechecks.get(check, (None, None))
+        if not length == len(self.header):
+            result = check(bytes(self.header), *args, content_type=self.content_type)
+            self.typechecks[check] = (len(self.header), result)
+        return result
+
+    def typecheck_html(self, filename=None):
         if not self.is_typechecked:
-            data = open(self.filename, 'r').read()
-            if data:
-                if filetype.is_html(data):
+            if self.header:
+                if self.memoized(filetype.is_html):
                     self.is_typechecked = True
 
-    def typecheck_urls(self, filename):
+    def typecheck_urls(self, filename=None):
         if not self.is_typechecked:
-            data = open(self.filename, 'r').read()
-            if data:
-                if not filetype.has_urls(data, self.url):
+            if self.header:
+                if not self.memoized(filetype.has_urls, self.url):
                     self.throw_type_error()
                 self.is_typechecked = True
 
+    def check_content_type(self):
+        """Classify the document by its content type, before the body is
+        read"""
+        if not self.is_typechecked and self.content_type:
+            kind = filetype.classify(self.content_type)
+            if self.prober:
+                self.prober.record(self.url, kind)
+            if kind == filetype.SPIDER:
+                self.is_typechecked = True
+            elif kind == filetype.FETCH:
+                self.throw_type_error()
+                self.is_typechecked = True
+
+    def probe(self):
+        """With $PROBE, classify the url from what we have seen before, or
+        failing that a HEAD request, and give up on it early if it can't be
+        spidered"""
+        if self.is_typechecked or not self.prober or not os.environ.get("PROBE"):
+            return
+        kind = self.prober.lookup(self.url)
+        if not kind and self.proto == self.PROTO_HTTP:
+            # a failed probe only means we find out from the download
+            try:
+                (conn, response) = self._opener.request_pooled("HEAD", self.url)
+                try:
+                    response.read()
+                except (IOError, httplib.HTTPException):
+                    connpool.pool.discard(conn)
+                    raise
+                connpool.pool.release(conn, response)
+                if response.status == 200:
+                    kind = filetype.classify(response.getheader("content-type"))
+                    self.prober.record(self.url, kind)
+            except (IOError, httplib.HTTPException):
+                pass
+        if kind == filetype.FETCH:
+            self.throw_type_error()
+            self.is_typechecked = True
+
     def throw_type_error(self):
         if self.fetch_if_wrongtype:
             self.action = "fetch"
@@ -531,49 +1041,134 @@ class Fetcher(object):
             raise filetype.WrongFileTypeError
 
     def fetch_hook(self, blocknum, blocksize, totalsize):
-        self.download_size = blocknum * blocksize
-
-        step = 5
-        if blocknum > 0 and blocknum % step == 0:
-            t = time.time()
-            interval = t - self.timestamp
+        """Called every so often with the number of bytes read so far, as
+        blocknum * blocksize"""
+        (last, self.download_size) = (self.download_size, blocknum * blocksize)
+        if totalsize and totalsize > 0:
+            self.totalsize = totalsize
+
+        t = time.time()
+        interval = t - self.timestamp
+        if last is None or interval <= 0:
             self.timestamp = t
-
-            rate = step * blocksize / max(interval, 0.1)
-            if totalsize and totalsize > 0:
-                self.totalsize = totalsize
+        elif self.download_size > last:
+            self.timestamp = t
+            rate = (self.download_size - last) / max(interval, 0.1)
             self.write_progress(rate=rate)
 
+    def reset(self, cont=False):
+        # init vars here as we might start fetching from a non-zero position
+        self.timestamp = time.time()
+        self.started = True
+        if self.extractor:
+            self.extractor.reset(self.url)
+        # the last try may have been at another url, after a redirect
+        self._opener.clear_request_headers()
+        self.reset_header(cont)
+        self.download_size = None
+        self.wire_size = None
+        self.decoded_size = 0
+        # only pages are hashed, to skip parsing the same one twice. A
+        # resumed download doesn't pass the start of the file to data_hook.
+        self.hasher = None
+        if self.mode == self.SPIDER and not cont:
+            self.hasher = hashlib.sha1()
+
+    def reset_header(self, cont=False):
+        self.header = bytearray()
+        self.content_type = None
+        self.typechecks = {}
+        if cont:
+            # only the rest of the file is going to come through data_hook
+            fp = open(self.filename, 'rb')
+            self.header.extend(fp.read(filetype.HEADER_SIZE_URLS))
+            fp.close()
+
+    def data_hook(self, block):
+        self.decoded_size += len(block)
+        if self.hasher:
+            self.hasher.update(block)
+        if len(self.header) < filetype.HEADER_SIZE_URLS:
+            self.header.extend(block[:filetype.HEADER_SIZE_URLS - len(self.header)])
         if not self.is_typechecked:
-            if self.download_size >= filetype.HEADER_SIZE_HTML:
+            if len(self.header) >= filetype.HEADER_SIZE_HTML:
                 self.typecheck_html(self.filename)
-            if self.download_size >= filetype.HEADER_SIZE_URLS:
+            if len(self.header) >= filetype.HEADER_SIZE_URLS:
                 self.typecheck_urls(self.filename)
+        if self.extractor:
+            if self.extractor.charset is None:
+                self.extractor.charset = spider.get_charset(self.content_type,
+                                                            self.header, default=None)
+            self.extractor.feed(block)
+
+    def can_continue(self):
+        """Resume if asked to, or if a manifest says the file is a partial
+        download. Downloads to a file object start over, and so do files
+        with a manifest that doesn't check out: they may have been extended
+        up front, and their tail is nothing to go by."""
+        if self.mode == self.SPIDER or not self.filename:
+            return False
+        if not (os.path.exists(self.filename) and os.path.getsize(self.filename) > 0):
+            return False
+        if manifest.Manifest.exists(self.filename):
+            state = manifest.Manifest.load(self.filename, self.url)
+            return bool(state and state.verify())
+        return bool(os.environ.get("CONT"))
+
+    def get_segments(self, cont=False):
+        """How many parts to download at once. Only new downloads to files
+        are split, a file object is written front to back."""
+        if (self.mode == self.FETCH and not cont and
+                self.filename and self.fileobj is None):
+            return int(os.environ.get("SEGMENTS") or 1)
+        return 1
+
+    def prepare(self):
+        """Get ready for a try, returns whether it resumes the download"""
+        cont = self.can_continue()
+        self.reset(cont)
+        self.probe()
+        return cont
 
     def inner_load_url(self):
-        cont = False
-        if not self.mode == self.SPIDER:
-            if (os.environ.get("CONT") and os.path.exists(self.filename)
-                    and os.path.getsize(self.filename) > 0):
-                cont = True
+        cont = self.prepare()
+        self.transfer(cont)
 
-        # init vars here as we might start fetching from a non-zero position
-        self.timestamp = time.time()
-        self.started = True
+    def transfer(self, cont=False):
+        segments = self.get_segments(cont)
+        try:
+            if segments > 1:
+                (_, headers) = self._opener.retrieve_segmented(
+                    self.url, self.filename, reporthook=self.fetch_hook,
+                    segments=segments)
+            else:
+                (_, headers) = self._opener.retrieve(self.url, self.fileobj or self.filename,
+                                                     reporthook=self.fetch_hook, cont=cont,
+                                                     datahook=self.data_hook)
+        finally:
+            self._opener.release_conn()
 
-        (_, headers) = self._opener.retrieve(self.url, self.filename,
-                                             reporthook=self.fetch_hook, cont=cont)
 
+    def content_hash(self):
+        """Digest of the body, if all of it went through data_hook"""
+        if self.hasher and self.decoded_size == self.download_size:
+            return self.hasher.hexdigest()
 
     def load_url(self):
         self.write_progress(prestart=True)
 
         self.inner_load_url()
 
-        self.download_size = os.path.getsize(self.filename)
+        self.finish_load_url()
+
+    def finish_load_url(self):
+        self.download_size = ioutils.get_size(self.fileobj or self.filename)
         if not self.download_size:
             raise ZeroDataError
 
+        if self.extractor:
+            self.extractor.close()
+
         """This was a check to detect zero data transmissions, but it
         causes ftp indices to fail, so it may be worthless. Reading the
         filesize might be more useful.
@@ -606,6 +1201,17 @@ class Fetcher(object):
             self.error = None
 
             self.load_url()
+        except Exception:
+            self.handle_exception()
+        except KeyboardInterrupt:
+            ioutils.write_abort()
+            raise
+
+    def handle_exception(self):
+        """Turn the exception being handled into an error code. Exceptions the
+        caller has to act on are re-raised."""
+        try:
+            raise
         except ChangedUrlWarning:
             self.handle_error(err.redirect)
             raise
@@ -625,31 +1231,31 @@ class Fetcher(object):
             if exc and exc.args:
                 if len(exc.args) == 2:
                     (_, errobj) = exc.args
-                    if type(errobj) == socket.gaierror:
+                    # on py3 these are subclasses of socket.error (OSError),
+                    # ConnectionRefusedError and such are too
+                    if isinstance(errobj, socket.gaierror):
                         self.handle_error(err.dns)
                         return
-                    elif type(errobj) == socket.timeout:
+                    elif isinstance(errobj, socket.timeout):
                         self.handle_error(err.timeout)
                         return
-                    elif type(errobj) == socket.sslerror:
+                    elif isinstance(errobj, sslerror):
                         self.handle_error(err.ssl)
                         return
-                    elif type(errobj) == socket.error:
+                    elif isinstance(errobj, socket.error):
                         self.handle_error(err.socket)
                         return
-                    elif type(errobj) == ftplib.error_perm:
+                    elif isinstance(errobj, ftplib.error_perm):
                         self.handle_error(err.auth)
                         return
             self.handle_error(err.url_error)
         except socket.timeout:
             self.handle_error(err.timeout)
-        except KeyboardInterrupt:
-            ioutils.write_abort()
-            raise
 
     def launch_w_tries(self):
         while True:
             self.tries -= 1
+            self.attempts += 1
 
             self.launch()
 
@@ -659,11 +1265,55 @@ class Fetcher(object):
             if self.tries < 1:
                 return
 
-            # retry after a short delay
+            # retry after a delay that grows with every try
+            self.retry_wait = int(retry.backoff(self.attempts, RETRY_WAIT))
             self.write_progress(wait=True)
             time.sleep(self.retry_wait)
 
 
+def testsuite():
+    """Fetch a .tar.gz served with Content-Encoding: gzip from a local
+    server. Downloads must keep the bytes as served, pages are decoded."""
+    import gzip
+    import io
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as g:
+        g.write(b"spiderfetch " * 1000)
+    body = buf.getvalue()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-tar")
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = "http://127.0.0.1:%s/foo.tar.gz" % server.server_address[1]
+    ok = True
+    try:
+        pages = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        for (name, mode, expected) in (("fetch", Fetcher.FETCH, body),
+                                       ("spider", Fetcher.SPIDER, pages)):
+            f = Fetcher(mode=mode, url=url, fileobj=ioutils.get_spooledfile())
+            f.fetch_if_wrongtype = True
+            f.launch_w_tries()
+            f.fileobj.seek(0)
+            intact = not f.error and f.fileobj.read() == expected
+            print("%s mode, bytes as expected: %s" % (name, intact))
+            ok = ok and intact
+    finally:
+        server.shutdown()
+    return ok
+
 
 if __name__ == "__main__":
     (parser, a) = ioutils.init_opts("<url>+ [options]")
@@ -671,9 +1321,15 @@ if __name__ == "__main__":
       help="Use full path as filename to avoid name collisions")
     a("-c", "--continue", dest="cont", action="store_true", help="Resume downloads")
     a("-t", "--tries", dest="tries", type="int", action="store", help="Number of retries")
+    a("-s", "--segments", dest="segments", type="int", action="store",
+      help="Download large files as this many parallel ranges")
     a("-q", "--quiet", dest="quiet", action="store_true", help="Turn off logging")
     a("--spidertest", action="store_true", help="Test spider with url")
+    a("--test", action="store_true", help="Run fetch testsuite")
     (opts, args) = ioutils.parse_args(parser)
+    if opts.test:
+        os.environ["LOGGING"] = str(False)
+        sys.exit(not testsuite())
     if getattr(opts, 'cont', None):
         os.environ["CONT"] = "1"
     if getattr(opts, 'tries', None):
@@ -681,6 +1337,8 @@ if __name__ == "__main__":
             os.environ["TRIES"] = str(opts.tries)
     if opts.quiet:
         os.environ["LOGGING"] = str(False)
+    if opts.segments:
+        os.environ["SEGMENTS"] = str(opts.segments)
     try:
         url = args[0]
         os.environ["SILENT_REDIRECT"] = "1"
@@ -701,7 +1359,9 @@ if __name__ == "__main__":
             while args:
                 url = args.pop()
                 filename = urlrewrite.url_to_filename(url)
-                if not os.environ.get("CONT"):
+                # a partial download with a manifest is picked up where it
+                # stopped, -c or not
+                if not (os.environ.get("CONT") or manifest.Manifest.exists(filename)):
                     filename = ioutils.safe_filename(filename)
                 try:
                     Fetcher(mode=Fetcher.FETCH, url=url,
@@ -3,10 +3,13 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import os
 import re
 import sys
+import threading
 
 from spiderfetch import spider
+from spiderfetch.compat import urlparse
 
 
 # how many bytes of the file to download before doing a type check
@@ -14,30 +17,116 @@ HEADER_SIZE_HTML = 1024
 HEADER_SIZE_URLS = 100 * 1024
 
 # ref: file-4.23.tar.gz/magic/Magdir/sgml
-html_regex = "(?ims).*<\s*(!DOCTYPE html|html|head|title|body)"
+html_regex = r"(?ims)<\s*(!DOCTYPE html|html|head|title|body)"
 _html_re = re.compile(html_regex)
+_html_re_bytes = re.compile(html_regex.encode('ascii'))
+
+# content types that are trusted without looking at the data
+HTML_TYPES = ("text/html", "application/xhtml+xml")
+BINARY_TYPES = ("image/", "audio/", "video/", "font/",
+                "application/zip", "application/x-gzip", "application/x-bzip2",
+                "application/x-iso9660-image", "application/x-tar",
+                "application/vnd.ms-cab-compressed")
+
+# what to do with a document
+SPIDER = "spider"
+FETCH = "fetch"
+
+# the same kind of document this many times before an extension is trusted,
+# scripts can serve anything so their urls are never guessed from
+PROBE_MIN_SEEN = 3
+DYNAMIC_EXTS = (".php", ".asp", ".aspx", ".cgi", ".jsp", ".pl", ".cfm")
 
 class WrongFileTypeError(Exception):
     pass
 
 
-def is_html(data):
-    if data and re.match(_html_re, data):
-        return True
+def get_mimetype(content_type):
+    if content_type:
+        return content_type.split(";")[0].strip().lower()
 
-def has_urls(data, url=None):
+def is_html(data, content_type=None):
+    if get_mimetype(content_type) in HTML_TYPES:
+        return True
     if data:
-        try:
-            next(spider.findall(data, url))
+        regex = _html_re if isinstance(data, type(u"")) else _html_re_bytes
+        if regex.search(data):
             return True
-        except StopIteration:
-            pass
+
+def is_binary(content_type):
+    mimetype = get_mimetype(content_type)
+    if mimetype:
+        return any([mimetype.startswith(t) for t in BINARY_TYPES])
+
+def classify(content_type):
+    """SPIDER or FETCH if the content type settles it, otherwise None"""
+    if is_html(None, content_type):
+        return SPIDER
+    if is_binary(content_type):
+        return FETCH
+
+def has_urls(data, url=None, content_type=None):
+    if is_binary(content_type):
+        return False
+    if data:
+        return bool(spider.extract(data, url, spider.get_charset(content_type, data)))
+
+
+class Prober(object):
+    """Remembers how documents were classified by the extension of their
+    url, so that the rest of the urls with that extension can be classified
+    without asking the server. An extension has to be seen min_seen times
+    as the same kind first, and one that turns out to be used for both kinds
+    of document is never guessed from again."""
+
+    def __init__(self, min_seen=PROBE_MIN_SEEN):
+        self.min_seen = min_seen
+        self.decisions = {}     # extension -> [kind, times seen]
+        self.lock = threading.Lock()
+
+    def get_key(self, url):
+        path = urlparse.urlsplit(url).path
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in DYNAMIC_EXTS:
+            return ext or None
+
+    def lookup(self, url):
+        key = self.get_key(url)
+        if key:
+            with self.lock:
+                (kind, seen) = self.decisions.get(key, (None, 0))
+                if seen >= self.min_seen:
+                    return kind
+
+    def record(self, url, kind):
+        key = self.get_key(url)
+        if key and kind:
+            with self.lock:
+                decision = self.decisions.setdefault(key, [kind, 0])
+                if decision[0] == kind:
+                    decision[1] += 1
+                else:
+                    decision[:] = [None, 0]
 
 
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--test"]:
+        prober = Prober(min_seen=2)
+        prober.record("http://host/a.iso", FETCH)
+        print("one sighting isn't trusted: %s" % (prober.lookup("http://host/b.iso") is None))
+        prober.record("http://host/c.iso", FETCH)
+        print("two are: %s" % (prober.lookup("http://host/b.iso") == FETCH))
+        prober.record("http://host/d.iso", SPIDER)
+        prober.record("http://host/e.iso", FETCH)
+        prober.record("http://host/f.iso", FETCH)
+        print("both kinds, never guessed: %s" % (prober.lookup("http://host/b.iso") is None))
+        for _ in range(3):
+            prober.record("http://host/captcha.php", FETCH)
+        print("scripts never guessed: %s" % (prober.lookup("http://host/page.php") is None))
+        sys.exit()
     try:
-        data = open(sys.argv[1], 'r').read()
+        data = open(sys.argv[1], 'rb').read()
         print("is_html:  %s" % is_html(data))
         print("has_urls: %s" % has_urls(data))
     except IndexError:
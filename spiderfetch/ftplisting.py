@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import calendar
+import re
+import sys
+import time
+
+from spiderfetch import ioutils
+
+
+# -rw-r--r--    1 1042     1042     28620269 Apr 19  2007 stage1-x86-2007.0.tar.bz2
+# lrwxrwxrwx    1 0        0              11 Jan  3 12:30 current -> 2007.0
+# drwxr-xr-x    2 ftp      ftp          4096 2007-04-19 12:00 releases
+_unix = r"""(?x)
+    (?P<type>[-dlbcps])\S{9}\S*\s+
+    \d+\s+                              # links
+    (?:\S+\s+)*?                        # owner and group, either may be missing
+    (?P<size>\d+)\s+
+    (?:(?P<month>[a-z]{3})\s+(?P<day>\d{1,2})\s+(?:(?P<year>\d{4})|(?P<time>\d{1,2}:\d{2}))
+      |(?P<isodate>\d{4}-\d{2}-\d{2})\s+(?P<isotime>\d{2}:\d{2}))
+    \s(?P<url>.+?)(?:\ ->\ (?P<target>.*?))?\r?$"""
+UNIX = re.compile(_unix, re.I)
+
+# 04-19-07  12:00PM       <DIR>          releases
+# 04-19-07  12:00PM             28620269 stage1-x86-2007.0.tar.bz2
+_windows = r"""(?x)
+    (?P<date>\d{2}-\d{2}-\d{2}(?:\d{2})?)\s+(?P<time>\d{1,2}:\d{2})(?P<ampm>[ap]m)?\s+
+    (?:(?P<dir><dir>)|(?P<size>\d+))\s+
+    (?P<url>.+?)\r?$"""
+WINDOWS = re.compile(_windows, re.I)
+
+# type=file;size=28620269;modify=20070419120000;perm=r; stage1-x86-2007.0.tar.bz2
+_mlsd = r"""(?P<facts>(?:[^;\s=]+=[^;]*;)+)\ (?P<url>.+?)\r?$"""
+MLSD = re.compile(_mlsd)
+
+FORMATS = (("unix", UNIX), ("windows", WINDOWS), ("mlsd", MLSD))
+
+MONTHS = dict([(m, i + 1) for (i, m) in
+               enumerate("jan feb mar apr may jun jul aug sep oct nov dec".split())])
+
+
+class Entry(object):
+    """A file, directory or link in a listing. size is in bytes, mtime in
+    seconds since the epoch (utc, or whatever the server's clock says), both
+    None if the listing doesn't say. match is what the line matched, the
+    name is its "url" group."""
+
+    FILE = "file"
+    DIR = "dir"
+    LINK = "link"
+
+    def __init__(self, name, kind, size=None, mtime=None, target=None, match=None):
+        self.name = name
+        self.kind = kind
+        self.size = size
+        self.mtime = mtime
+        self.target = target
+        self.match = match
+
+    def get_url(self):
+        """The name as a link relative to the directory, directories end in
+        a slash so they're listed in turn"""
+        if self.kind == self.DIR:
+            return self.name + "/"
+        return self.name
+
+
+def unix_mtime(m, now=None):
+    if m.group("isodate"):
+        t = time.strptime("%s %s" % (m.group("isodate"), m.group("isotime")), "%Y-%m-%d %H:%M")
+        return calendar.timegm(t)
+    month = MONTHS.get(m.group("month").lower())
+    if not month:
+        return None
+    day = int(m.group("day"))
+    if m.group("year"):
+        return calendar.timegm((int(m.group("year")), month, day, 0, 0, 0))
+    # no year means the last six months, ls leaves it out for those
+    (hour, minute) = [int(x) for x in m.group("time").split(":")]
+    now = now or time.time()
+    year = time.gmtime(now).tm_year
+    mtime = calendar.timegm((year, month, day, hour, minute, 0))
+    if mtime > now + 86400:
+        mtime = calendar.timegm((year - 1, month, day, hour, minute, 0))
+    return mtime
+
+def windows_mtime(m):
+    (month, day, year) = [int(x) for x in m.group("date").split("-")]
+    if year < 100:
+        year += 2000 if year < 70 else 1900
+    (hour, minute) = [int(x) for x in m.group("time").split(":")]
+    ampm = (m.group("ampm") or "").lower()
+    if ampm == "pm" and hour < 12:
+        hour += 12
+    elif ampm == "am" and hour == 12:
+        hour = 0
+    return calendar.timegm((year, month, day, hour, minute, 0))
+
+def make_entry(format, m):
+    name = m.group("url")
+    if format == "unix":
+        kind = {"d": Entry.DIR, "l": Entry.LINK}.get(m.group("type"), Entry.FILE)
+        return Entry(name, kind, int(m.group("size")), unix_mtime(m),
+                     target=m.group("target"), match=m)
+    if format == "windows":
+        kind = Entry.DIR if m.group("dir") else Entry.FILE
+        size = int(m.group("size")) if m.group("size") else None
+        return Entry(name, kind, size, windows_mtime(m), match=m)
+    facts = dict([fact.split("=", 1) for fact in m.group("facts").split(";") if fact])
+    facts = dict([(k.lower(), v) for (k, v) in facts.items()])
+    kind = facts.get("type", "").lower()
+    if kind in ("cdir", "pdir"):
+        return None
+    kind = {"dir": Entry.DIR, "os.unix=symlink": Entry.LINK}.get(kind, Entry.FILE)
+    size = facts.get("size")
+    mtime = facts.get("modify")
+    if mtime:
+        try:
+            mtime = calendar.timegm(time.strptime(mtime[:14], "%Y%m%d%H%M%S"))
+        except ValueError:
+            mtime = None
+    return Entry(name, kind, int(size) if size and size.isdigit() else None, mtime, match=m)
+
+def parse(s):
+    """Yields the entries in the listing s. Every line is matched once, on
+    its own, against the format that matched the line before first, so a
+    listing of any length is parsed in one pass."""
+    formats = list(FORMATS)
+    pos = 0
+    while pos < len(s):
+        end = s.find("\n", pos)
+        if end < 0:
+            end = len(s)
+        for (i, (format, regex)) in enumerate(formats):
+            m = regex.match(s, pos, end)
+            if m:
+                if i > 0:
+                    formats.insert(0, formats.pop(i))
+                entry = make_entry(format, m)
+                if entry and entry.name not in (".", ".."):
+                    yield entry
+                break
+        pos = end + 1
+
+
+def testsuite():
+    """Parse a listing with a line of every kind in each format"""
+    listing = "\r\n".join([
+        "drwxr-xr-x    2 ftp      ftp          4096 2007-04-19 12:00 releases",
+        "-rw-r--r--    1 1042     1042     28620269 Apr 19  2007 stage1.tar.bz2",
+        "lrwxrwxrwx    1 0        0              11 Jan  3 12:30 current -> 2007.0",
+        "04-19-07  12:00PM       <DIR>          win",
+        "04-19-07  12:00PM             28620269 win.bin",
+        "type=cdir;modify=20070419120000; .",
+        "type=file;size=10;modify=20070419120000;perm=r; mlsd file.bin",
+    ])
+    entries = list(parse(listing))
+    found = [(e.kind, e.size, e.get_url()) for e in entries]
+    expected = [(Entry.DIR, 4096, "releases/"),
+                (Entry.FILE, 28620269, "stage1.tar.bz2"),
+                (Entry.LINK, 11, "current"),
+                (Entry.DIR, None, "win/"),
+                (Entry.FILE, 28620269, "win.bin"),
+                (Entry.FILE, 10, "mlsd file.bin")]
+    noon = calendar.timegm((2007, 4, 19, 12, 0, 0))
+    checks = [("entries", found == expected),
+              ("link target", entries[2].target == "2007.0"),
+              ("mtimes", [e.mtime for e in entries if not e.kind == Entry.LINK] ==
+               [noon, noon - 12 * 3600, noon, noon, noon])]
+    for (name, ok) in checks:
+        print("%s: %s" % (name, ok))
+    return all([ok for (_, ok) in checks])
+
+
+
+if __name__ == "__main__":
+    (parser, a) = ioutils.init_opts("<file> | --test")
+    a("--test", action="store_true", help="Run ftplisting testsuite")
+    (opts, args) = ioutils.parse_args(parser)
+    if opts.test:
+        sys.exit(not testsuite())
+    if not args:
+        ioutils.opts_help(None, None, None, parser)
+    with open(args[0], 'rb') as f:
+        s = f.read().decode('utf-8', 'replace')
+    t = time.time()
+    entries = list(parse(s))
+    t = time.time() - t
+    for entry in entries:
+        mtime = entry.mtime and time.strftime("%Y-%m-%d %H:%M", time.gmtime(entry.mtime))
+        print("%s %12s  %16s  %s" % (entry.kind.ljust(4), entry.size, mtime, entry.get_url()))
+    sys.stderr.write("%s entries in %.3fs\n" % (len(entries), t))
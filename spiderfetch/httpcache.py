@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import email
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+
+from spiderfetch import ioutils
+from spiderfetch import urlrewrite
+
+
+# default cap on the size of the cache, in MB
+CACHE_SIZE = 100
+
+
+class ResponseCache(object):
+    """Keeps response bodies on disk along with their ETag/Last-Modified
+    headers, so that a page can be revalidated with a conditional request
+    and reused if the server says 304. Entries are keyed by normalized url
+    and the least recently used ones are evicted once the cache grows past
+    maxsize bytes."""
+
+    def __init__(self, dir, maxsize):
+        self.dir = dir
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+
+        # key -> [size, last used], rebuilt from the files on disk
+        self.index = {}
+        self.size = 0
+        ioutils.create_dir(dir)
+        for filename in os.listdir(dir):
+            (key, ext) = os.path.splitext(filename)
+            if ext == ".body" and ioutils.file_exists(key + ".meta", dir=dir):
+                st = os.stat(os.path.join(dir, filename))
+                self.index[key] = [st.st_size, st.st_mtime]
+                self.size += st.st_size
+
+    def get_key(self, url):
+        url = urlrewrite.normalize_url(url)
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def lookup(self, url):
+        key = self.get_key(url)
+        with self.lock:
+            if key not in self.index:
+                return None
+        try:
+            meta = ioutils.deserialize(key + ".meta", dir=self.dir)
+        except (IOError, EOFError):
+            return None
+        if meta.get("url") == urlrewrite.normalize_url(url):
+            return meta
+
+    def validators(self, url):
+        """Headers for a conditional request on url"""
+        pairs = []
+        meta = self.lookup(url)
+        if meta:
+            if meta.get("etag"):
+                pairs.append(("If-None-Match", meta["etag"]))
+            if meta.get("last_modified"):
+                pairs.append(("If-Modified-Since", meta["last_modified"]))
+        return pairs
+
+    def store(self, url, headers, filename):
+        etag = headers.get("etag")
+        last_modified = headers.get("last-modified")
+        if not (etag or last_modified):
+            return
+
+        key = self.get_key(url)
+        meta = {"url": urlrewrite.normalize_url(url),
+                "etag": etag,
+                "last_modified": last_modified,
+                "headers": str(headers)}
+        body = os.path.join(self.dir, key + ".body")
+        fp = ioutils.open_file(filename, 'rb')
+        with open(body + ".partial", 'wb') as tfp:
+            shutil.copyfileobj(fp, tfp)
+        ioutils.close_file(fp, filename)
+        os.rename(body + ".partial", body)
+        ioutils.serialize(meta, key + ".meta", dir=self.dir)
+
+        size = os.path.getsize(body)
+        with self.lock:
+            if key in self.index:
+                self.size -= self.index[key][0]
+            self.index[key] = [size, time.time()]
+            self.size += size
+            self.evict()
+
+    def restore(self, url, filename):
+        """Copy the cached body of url to filename, returns its headers"""
+        key = self.get_key(url)
+        meta = ioutils.deserialize(key + ".meta", dir=self.dir)
+        body = os.path.join(self.dir, key + ".body")
+        tfp = ioutils.open_file(filename, 'wb')
+        with open(body, 'rb') as fp:
+            shutil.copyfileobj(fp, tfp)
+        ioutils.close_file(tfp, filename)
+        t = time.time()
+        os.utime(body, (t, t))
+        with self.lock:
+            if key in self.index:
+                self.index[key][1] = t
+        return email.message_from_string(meta["headers"])
+
+    def evict(self):
+        if self.size <= self.maxsize:
+            return
+        lru = sorted(self.index.items(), key=lambda item: item[1][1])
+        for (key, (size, _)) in lru:
+            if self.size <= self.maxsize:
+                break
+            for ext in (".body", ".meta"):
+                if ioutils.file_exists(key + ext, dir=self.dir):
+                    ioutils.delete(key + ext, dir=self.dir)
+            del self.index[key]
+            self.size -= size
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """The cache in $CACHE_DIR, or None if caching isn't enabled"""
+    global _cache
+    dir = os.environ.get("CACHE_DIR")
+    if not dir:
+        return None
+    with _cache_lock:
+        if _cache is None or not _cache.dir == dir:
+            maxsize = int(os.environ.get("CACHE_SIZE") or CACHE_SIZE) * 1024 * 1024
+            _cache = ResponseCache(dir, maxsize)
+    return _cache
+
+def testsuite():
+    """Store pages in a cache in a temp directory and read them back"""
+    import tempfile
+    dir = tempfile.mkdtemp()
+    (fp, filename) = tempfile.mkstemp()
+    os.close(fp)
+    headers = email.message_from_string('Content-Type: text/html\nETag: "v1"\n\n')
+    checks = []
+    try:
+        cache = ResponseCache(os.path.join(dir, "cache"), 1000)
+        with open(filename, 'wb') as f:
+            f.write(b"a" * 600)
+        cache.store("http://host/a", headers, filename)
+        checks.append(("validators",
+                       cache.validators("http://host/a") == [("If-None-Match", '"v1"')]))
+        os.unlink(filename)
+        restored = cache.restore("http://host/a", filename)
+        with open(filename, 'rb') as f:
+            checks.append(("body restored", f.read() == b"a" * 600))
+        checks.append(("headers restored", restored.get("etag") == '"v1"'))
+
+        with open(filename, 'wb') as f:
+            f.write(b"b" * 600)
+        cache.store("http://host/b", headers, filename)
+        checks.append(("least recently used evicted",
+                       cache.lookup("http://host/a") is None and
+                       cache.lookup("http://host/b") is not None))
+        cache.store("http://host/c", email.message_from_string("\n"), filename)
+        checks.append(("pages without validators skipped",
+                       cache.lookup("http://host/c") is None))
+        cache = ResponseCache(os.path.join(dir, "cache"), 1000)
+        checks.append(("index rebuilt", list(cache.index.keys()) ==
+                       [cache.get_key("http://host/b")]))
+    finally:
+        os.unlink(filename)
+        shutil.rmtree(dir)
+    for (name, ok) in checks:
+        print("%s: %s" % (name, ok))
+    return all([ok for (_, ok) in checks])
+
+
+
+if __name__ == "__main__":
+    (parser, a) = ioutils.init_opts("<cachedir> [options] | --test")
+    a("--lookup", metavar="<url>", dest="lookup", help="Show cache entry for <url>")
+    a("--test", action="store_true", help="Run httpcache testsuite")
+    (opts, args) = ioutils.parse_args(parser)
+    if opts.test:
+        sys.exit(not testsuite())
+    try:
+        cache = ResponseCache(args[0], CACHE_SIZE * 1024 * 1024)
+        if opts.lookup:
+            meta = cache.lookup(opts.lookup)
+            if not meta:
+                ioutils.write_err("Url %s not in the cache\n" % opts.lookup)
+                sys.exit(1)
+            for k in ("url", "etag", "last_modified"):
+                print("%s: %s" % (k.ljust(14), meta.get(k)))
+        else:
+            print("Entries : %s" % len(cache.index))
+            print("Size    : %s bytes" % cache.size)
+    except IndexError:
+        ioutils.opts_help(None, None, None, parser)
@@ -3,13 +3,16 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import hashlib
 import optparse
 import os
+import re
 import tempfile
 import sys
 
 import ansicolor
 
+from spiderfetch import logwriter
 from spiderfetch.compat import pickle
 
 
@@ -27,6 +30,7 @@ found). At this point the web is saved to $host.web.
 
 During execution, successful fetches are written to log_urls, failed fetches
 to error_urls, and outright errors (that shouldn't happen) to error_log.
+Pages only partly searched for urls are written to truncated_urls.
 
 == web ==
 
@@ -51,12 +55,31 @@ from a file and records with mplayer.
 
 _help_vars = """\
 SOCKET_TIMEOUT   Seconds to wait before calling a socket timeout.
-TRIES            Number of tries on timeout errors.
+TRIES            Number of tries on temporary errors, with growing delays.
+CONNS_PER_HOST   Http connections to keep alive per host, 0 to disable.
+SEGMENTS         Fetch large files as this many parallel byte ranges.
+DNS_TTL          Seconds to cache host lookups for, 0 to disable.
+RATE             Requests per second, overall. Recipe rules can set "rate".
+HOST_RATE        Requests per second to each host ("host_rate").
+BANDWIDTH        Bytes per second, overall, eg. 500k ("bandwidth").
+HOST_BANDWIDTH   Bytes per second from each host ("host_bandwidth").
+PARSER           How to find urls in pages: regex or html (tokenizer).
+PARSE_PROCS      Find urls in pages on this many processes.
+PARSE_MAX_SIZE   Only look for urls in the first part of a page, eg. 8m.
+PARSE_MAX_URLS   Stop looking for urls in a page after finding this many.
+PARSE_TIME       Seconds to spend looking for urls in a page, at most.
+                 Pages cut short by these are logged to truncated_urls, ftp
+                 listings are always read in full.
+LOG_FLUSH        Seconds to hold log lines before writing, 0 writes at once.
+LOG_MAX_SIZE     Rotate logs past this size, eg. 10m, keeping 3 old ones.
+SITEMAPS         Start with the urls in the sitemaps robots.txt lists.
 
 ORIG_FILENAMES   Save files with their original filenames on the host (1) or
   use filenames generated from the full url to avoid name collisions (0).
 TMPDIR           Temp directory for downloads.
 LOGDIR           Directory to use for logfiles.
+CACHE_DIR        Directory to cache spidered pages in for revalidation.
+CACHE_SIZE       Size limit of the cache in MB.
 
 TERM             When set and not 'dumb' gives color output.
 DEBUG_FETCH      Write newlines after every update to see the full output.
@@ -67,6 +90,9 @@ VANILLA_USER_AGENT  Don't cloak the user agent.
 #LOGDIR = os.environ.get("LOGDIR") or "logs"
 LOGDIR = os.environ.get("LOGDIR") or "."
 
+# spooled tempfiles stay in memory until they grow past this size
+SPOOL_SIZE = 1024 * 1024
+
 def write_out(s):
     sys.stdout.write(s)
 
@@ -80,6 +106,56 @@ def write_abort():
 def get_tempfile():
     return tempfile.mkstemp(prefix="." + os.path.basename(sys.argv[0]) + ".")
 
+def get_partfile(url):
+    """Where to download url to, the same place every time"""
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(LOGDIR, ".spiderfetch.%s.part" % key)
+
+def get_spooledfile():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE,
+                                         prefix="." + os.path.basename(sys.argv[0]) + ".")
+
+def open_file(file, mode):
+    """Open a filename, or rewind a file object (emptying it if opened for
+    writing) so the two can be used interchangeably"""
+    if hasattr(file, 'read'):
+        file.seek(0)
+        if 'w' in mode:
+            file.truncate()
+        return file
+    return open(file, mode)
+
+def close_file(fp, file):
+    """Close what open_file() returned, file objects are left open"""
+    if fp is not file:
+        fp.close()
+
+def get_size(file):
+    if hasattr(file, 'read'):
+        file.seek(0, os.SEEK_END)
+        return file.tell()
+    return os.path.getsize(file)
+
+def parse_size(s):
+    """Parse a size like 500, 200k or 1.5m. The result is a float, so it
+    does for rates as well."""
+    m = re.match(r'^\s*([0-9.]+)\s*([kmg]?)\s*$', str(s).lower())
+    if not m:
+        raise ValueError("Bad size: %s" % s)
+    units = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    return float(m.group(1)) * units[m.group(2)]
+
+def preallocate(fp, size):
+    """Reserve disk space for a file about to be written up to size bytes, so
+    it doesn't end up in fragments. The file is extended to size."""
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fp.fileno(), 0, size)
+    except (OSError, ValueError):
+        # not every filesystem can do it, and that's fine
+        pass
+
 def safe_filename(filename, dir=None):
     if dir:
         filename = os.path.join(dir, filename)
@@ -110,9 +186,9 @@ def delete(filename, dir=None):
     return os.unlink(filename)
 
 def savelog(s, filename, mode=None):
-    create_dir(LOGDIR)
+    """Appends are buffered, see logwriter.LogWriter"""
     mode = mode or 'w'
-    open(os.path.join(LOGDIR, filename), mode).write(s)
+    logwriter.get_writer(LOGDIR).write(s, filename, mode)
 
 def serialize(o, filename, dir=None):
     if dir:
@@ -179,6 +255,7 @@ if __name__ == "__main__":
         (fp, filename) = get_tempfile()
         serialize(s, filename)
         print("Serialization sanity check:", s == deserialize(filename))
+        print("Size sanity check:", parse_size("1.5k") == 1536)
     finally:
         os.close(fp)
         os.unlink(filename)
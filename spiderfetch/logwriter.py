@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import atexit
+import os
+import threading
+import time
+
+
+# write out what has been logged after this many seconds, or as soon as this
+# many bytes are waiting
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 64 * 1024
+
+# rotated logs kept, as <file>.1 to <file>.<n>
+BACKUPS = 3
+
+
+class LogWriter(object):
+    """Appends lines to the logs in dir. The files are kept open and lines
+    are collected in memory, a background thread writes them out every
+    flush_interval seconds, when flush_size bytes are waiting, and when the
+    process exits. A log that grows past max_size is rotated. With a
+    flush_interval of 0 every line is written straight away."""
+
+    def __init__(self, dir, flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE,
+                 max_size=None, backups=BACKUPS):
+        self.dir = dir
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_size = max_size
+        self.backups = backups
+
+        self.lock = threading.Lock()        # guards the buffers
+        self.io_lock = threading.Lock()     # guards the files
+        self.wakeup = threading.Condition(self.lock)
+        self.buffers = {}   # filename -> [line]
+        self.pending = 0
+        self.files = {}     # filename -> open file
+        self.thread = None
+        self.closed = False
+
+    def get_path(self, filename):
+        return os.path.join(self.dir, filename)
+
+    def write(self, s, filename, mode='a'):
+        if not mode.startswith('a'):
+            # overwriting doesn't mix with anything buffered
+            self.flush()
+            with self.io_lock:
+                self.close_file(filename)
+                self.create_dir()
+                with open(self.get_path(filename), mode) as fp:
+                    fp.write(s)
+            return
+
+        with self.lock:
+            self.buffers.setdefault(filename, []).append(s)
+            self.pending += len(s)
+            if self.closed or not self.flush_interval:
+                flush = True
+            else:
+                flush = False
+                self.start()
+                if self.pending >= self.flush_size:
+                    self.wakeup.notify()
+        if flush:
+            self.flush()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.pending < self.flush_size and not self.closed:
+                    self.wakeup.wait(self.flush_interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Write out everything logged so far"""
+        with self.io_lock:
+            with self.lock:
+                (buffers, self.buffers) = (self.buffers, {})
+                self.pending = 0
+            for (filename, lines) in buffers.items():
+                self.write_lines(filename, lines)
+
+    def write_lines(self, filename, lines):
+        fp = self.get_file(filename)
+        if self.max_size:
+            # rotate in the middle of the batch if it crosses max_size
+            (size, start) = (fp.tell(), 0)
+            for (i, s) in enumerate(lines):
+                size += len(s)
+                if size >= self.max_size:
+                    fp.write("".join(lines[start:i + 1]))
+                    self.rotate(filename)
+                    fp = self.get_file(filename)
+                    (size, start) = (0, i + 1)
+            lines = lines[start:]
+        fp.write("".join(lines))
+        fp.flush()
+
+    def create_dir(self):
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+
+    def get_file(self, filename):
+        if filename not in self.files:
+            self.create_dir()
+            self.files[filename] = open(self.get_path(filename), 'a')
+        return self.files[filename]
+
+    def close_file(self, filename):
+        fp = self.files.pop(filename, None)
+        if fp:
+            fp.close()
+
+    def rotate(self, filename):
+        """log -> log.1 -> log.2 ..., the oldest is dropped"""
+        self.close_file(filename)
+        path = self.get_path(filename)
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%s" % (path, i)):
+                os.rename("%s.%s" % (path, i), "%s.%s" % (path, i + 1))
+        if self.backups > 0:
+            os.rename(path, "%s.1" % path)
+        else:
+            os.unlink(path)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.flush()
+        with self.io_lock:
+            for filename in list(self.files):
+                self.close_file(filename)
+
+writers = {}
+_writers_lock = threading.Lock()
+
+def get_writer(dir):
+    """The writer for logs in dir, configured by $LOG_FLUSH and
+    $LOG_MAX_SIZE the first time it's asked for"""
+    # ioutils writes its logs through here
+    from spiderfetch import ioutils
+    with _writers_lock:
+        if dir not in writers:
+            interval = os.environ.get("LOG_FLUSH")
+            max_size = os.environ.get("LOG_MAX_SIZE")
+            writers[dir] = LogWriter(
+                dir,
+                flush_interval=float(interval or FLUSH_INTERVAL),
+                max_size=int(ioutils.parse_size(max_size)) if max_size else None)
+        return writers[dir]
+
+@atexit.register
+def close_all():
+    for writer in list(writers.values()):
+        writer.close()
+
+
+
+if __name__ == "__main__":
+    import tempfile
+    dir = tempfile.mkdtemp()
+    writer = LogWriter(dir, max_size=50 * 1024, backups=2)
+    t = time.time()
+    for i in range(100000):
+        writer.write("line %s of the log\n" % i, "log")
+    writer.close()
+    print("100000 lines in %.2fs" % (time.time() - t))
+    for name in sorted(os.listdir(dir)):
+        path = os.path.join(dir, name)
+        print("%s  %s bytes" % (name.ljust(8), os.path.getsize(path)))
+        os.unlink(path)
+    os.rmdir(dir)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import os
+import re
+import sys
+
+from spiderfetch import ioutils
+
+
+# the unit in which a download is verified and resumed
+BLOCK_SIZE = 1024 * 1024
+
+
+class Manifest(object):
+    """Sits next to a download in progress, in <filename>.manifest, and
+    records what it's a download of: the url, the validators and size the
+    server gave, and the hash of every block written so far. A block is only
+    recorded once it's on disk, so after a crash everything the manifest
+    covers can be kept and the download resumed exactly where it stopped."""
+
+    fields = ("url", "etag", "last_modified", "size", "block_size", "hashes")
+
+    def __init__(self, filename, url):
+        self.filename = filename
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.size = -1
+        self.block_size = BLOCK_SIZE
+        self.hashes = []
+
+        # the block being written
+        self.hasher = hashlib.sha1()
+        self.pending = 0
+
+    @classmethod
+    def get_path(cls, filename):
+        return filename + ".manifest"
+
+    @classmethod
+    def exists(cls, filename):
+        return os.path.exists(cls.get_path(filename))
+
+    @classmethod
+    def load(cls, filename, url):
+        """The manifest of a partial download of url to filename, if any"""
+        try:
+            d = ioutils.deserialize(cls.get_path(filename))
+        except Exception:
+            return None
+        if not d.get("url") == url:
+            return None
+        m = cls(filename, url)
+        for k in cls.fields:
+            setattr(m, k, d.get(k, getattr(m, k)))
+        return m
+
+    def save(self):
+        d = dict([(k, getattr(self, k)) for k in self.fields])
+        ioutils.serialize(d, self.get_path(self.filename))
+
+    def remove(self):
+        if self.exists(self.filename):
+            os.unlink(self.get_path(self.filename))
+
+    def verified_size(self):
+        return len(self.hashes) * self.block_size
+
+    def get_validator(self):
+        """For If-Range, which only takes strong etags"""
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+    def hash_block(self, n):
+        fp = open(self.filename, 'rb')
+        try:
+            fp.seek(n * self.block_size)
+            return hashlib.sha1(fp.read(self.block_size)).hexdigest()
+        finally:
+            fp.close()
+
+    def verify(self):
+        """Check that the file still holds what the manifest says. Only the
+        last block is read back, the ones before it were on disk before it
+        was written. Returns the number of bytes that can be kept."""
+        if not self.hashes or not self.get_validator():
+            return 0
+        if (not os.path.exists(self.filename) or
+                os.path.getsize(self.filename) < self.verified_size()):
+            return 0
+        if not self.hash_block(len(self.hashes) - 1) == self.hashes[-1]:
+            return 0
+        return self.verified_size()
+
+    def start(self, headers, offset=0):
+        """Called when the body of the response starts, to be written at
+        offset. Anything already in the file before offset that isn't
+        recorded yet gets hashed."""
+        self.etag = headers.get("etag")
+        self.last_modified = headers.get("last-modified")
+        self.size = -1
+        m = re.match(r'bytes\s+\d+-\d+/(\d+)', headers.get("content-range") or "")
+        if m:
+            self.size = int(m.group(1))
+        elif headers.get("content-length"):
+            self.size = offset + int(headers.get("content-length"))
+        self.record_to(offset)
+
+    def record_to(self, offset):
+        """Record what's in the file up to offset, and forget anything
+        recorded past it"""
+        del self.hashes[offset // self.block_size:]
+        self.hasher = hashlib.sha1()
+        self.pending = 0
+        fp = open(self.filename, 'rb')
+        fp.seek(self.verified_size())
+        left = offset - self.verified_size()
+        while left > 0:
+            data = fp.read(min(left, self.block_size))
+            if not data:
+                break
+            self.update(data)
+            left -= len(data)
+        fp.close()
+        self.save()
+
+    def update(self, data, fp=None):
+        """Count data written to fp, fp is synced before a block is recorded"""
+        while data:
+            n = min(len(data), self.block_size - self.pending)
+            self.hasher.update(data[:n])
+            self.pending += n
+            data = data[n:]
+            if self.pending == self.block_size:
+                self.hashes.append(self.hasher.hexdigest())
+                self.hasher = hashlib.sha1()
+                self.pending = 0
+                if fp:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                    self.save()
+
+
+def testsuite():
+    """Record a download in small blocks and check what can be resumed"""
+    import tempfile
+    (fp, filename) = tempfile.mkstemp()
+    os.close(fp)
+    checks = []
+    try:
+        state = Manifest(filename, "http://host/file")
+        state.block_size = 4
+        state.start({"etag": '"v1"', "content-length": "10"})
+        with open(filename, 'wb') as f:
+            f.write(b"0123456789")
+            state.update(b"0123456789", f)
+        state = Manifest.load(filename, "http://host/file")
+        checks.append(("size", state.size == 10))
+        checks.append(("whole blocks resumable", state.verify() == 8))
+        checks.append(("other urls ignored",
+                       Manifest.load(filename, "http://host/other") is None))
+        with open(filename, 'rb+') as f:
+            f.seek(5)
+            f.write(b"x")
+        checks.append(("changed last block not resumable", state.verify() == 0))
+        state.record_to(4)
+        checks.append(("recorded again up to 4", state.verify() == 4))
+        state.etag = 'W/"v1"'
+        checks.append(("weak etag not resumable", state.verify() == 0))
+    finally:
+        os.unlink(filename)
+        Manifest(filename, None).remove()
+    for (name, ok) in checks:
+        print("%s: %s" % (name, ok))
+    return all([ok for (_, ok) in checks])
+
+
+
+if __name__ == "__main__":
+    (parser, a) = ioutils.init_opts("<file> | --test")
+    a("--test", action="store_true", help="Run manifest testsuite")
+    (opts, args) = ioutils.parse_args(parser)
+    if opts.test:
+        sys.exit(not testsuite())
+    if not args:
+        ioutils.opts_help(None, None, None, parser)
+    try:
+        d = ioutils.deserialize(Manifest.get_path(args[0]))
+    except IOError:
+        ioutils.write_err("No manifest for %s\n" % args[0])
+        sys.exit(1)
+    m = Manifest.load(args[0], d.get("url"))
+    print("Url      : %s" % m.url)
+    print("Etag     : %s" % m.etag)
+    print("Modified : %s" % m.last_modified)
+    print("Size     : %s bytes" % m.size)
+    print("Verified : %s bytes in %s blocks" % (m.verified_size(), len(m.hashes)))
+    print("Resumable: %s" % bool(m.verify()))
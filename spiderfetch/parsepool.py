@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import threading
+import time
+
+from spiderfetch import ioutils
+from spiderfetch import spider
+from spiderfetch import urlrewrite
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+# documents at least this big are handed over in shared memory, smaller
+# ones are cheaper to pickle
+SHM_MIN_SIZE = 64 * 1024
+
+
+def attach(name):
+    """Open the shared memory block called name without taking ownership of
+    it, the process that made it unlinks it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13 opening a block registers it with the resource
+        # tracker, but the pool's processes share ours, which already has it
+        return shared_memory.SharedMemory(name=name)
+
+def init_worker():
+    # what the budget cuts short is counted and logged by the parent
+    spider.truncated = spider.Truncations(log=False)
+
+def parse(url, payload, charset):
+    """Runs in a worker process. Finds the urls in the document payload
+    describes, returns them rewritten by urlrewrite.rewrite_urls, and the
+    limit of the parse budget the document ran into, if any."""
+    (kind, data) = payload[:2]
+    shm = None
+    if kind == "shm":
+        shm = attach(data)
+        data = shm.buf[:payload[2]]
+    try:
+        if kind == "file":
+            budget = spider.Budget(url)
+            urls = spider.extract_file(data, url, budget=budget)
+        else:
+            extractor = spider.get_extractor(url)
+            extractor.charset = charset
+            extractor.feed(data)
+            extractor.close()
+            (urls, budget) = (extractor.urls, extractor.budget)
+        limit = budget.exceeded and budget.exceeded[0]
+        return list(urlrewrite.rewrite_urls(url, urls)), limit
+    finally:
+        if shm:
+            del data
+            shm.close()
+
+
+class ParsePool(object):
+    """Finds the urls in documents on a pool of processes, so that parsing
+    isn't held up by the GIL, nor holds up the downloads. Documents are
+    passed by path if they're in a file, in shared memory if they're big,
+    and only the urls come back."""
+
+    def __init__(self, procs):
+        import multiprocessing
+        # forking a process full of threads isn't safe
+        context = multiprocessing.get_context("spawn")
+        self.executor = futures.ProcessPoolExecutor(procs, mp_context=context,
+                                                    initializer=init_worker)
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.shared = 0
+
+    def submit(self, url, file, charset=None):
+        """Parse file, a filename or a file object, returns (future, cleanup)
+        where cleanup has to be called once the future is done"""
+        shm = None
+        if not hasattr(file, 'read'):
+            payload = ("file", file)
+        else:
+            size = ioutils.get_size(file)
+            file.seek(0)
+            if shared_memory and size >= SHM_MIN_SIZE:
+                shm = shared_memory.SharedMemory(create=True, size=size)
+                self.copy(file, shm.buf, size)
+                payload = ("shm", shm.name, size)
+            else:
+                payload = ("bytes", file.read())
+        with self.lock:
+            self.documents += 1
+            self.shared += bool(shm)
+
+        def cleanup():
+            if shm:
+                shm.close()
+                shm.unlink()
+        try:
+            job = self.executor.submit(parse, url, payload, charset)
+        except Exception:
+            cleanup()
+            raise
+
+        # the urls are passed on, what the budget cut short is counted here
+        # as the workers' counts are lost with them
+        future = futures.Future()
+        def done(job):
+            try:
+                (urls, limit) = job.result()
+            except Exception as exc:
+                future.set_exception(exc)
+                return
+            if limit:
+                spider.truncated.add(limit, url)
+            future.set_result(urls)
+        job.add_done_callback(done)
+        return future, cleanup
+
+    def copy(self, file, buf, size):
+        pos = 0
+        while pos < size:
+            data = file.read(min(1024 * 1024, size - pos))
+            if not data:
+                break
+            buf[pos:pos + len(data)] = data
+            pos += len(data)
+
+    def stats(self):
+        return "%s documents, %s in shared memory" % (self.documents, self.shared)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The pool for $PARSE_PROCS processes, None if it's not set or this
+    python can't do it"""
+    global pool
+    procs = int(os.environ.get("PARSE_PROCS") or 0)
+    if procs < 1 or futures is None:
+        return None
+    with _pool_lock:
+        if pool is None:
+            pool = ParsePool(procs)
+    return pool
+
+
+def testsuite():
+    """Parse a document passed each way on a pool of one process"""
+    if futures is None:
+        print("no concurrent.futures, skipped")
+        return True
+    import io
+    import tempfile
+    doc = b'<a href="/a.html">a</a> http://other/b.html'
+    expected = ["http://host/a.html", "http://other/b.html"]
+    (fp, filename) = tempfile.mkstemp()
+    os.write(fp, doc)
+    os.close(fp)
+    pool = ParsePool(1)
+    checks = []
+    try:
+        files = [("file", filename), ("bytes", io.BytesIO(doc))]
+        if shared_memory:
+            files.append(("shared memory", io.BytesIO(doc + b" " * SHM_MIN_SIZE)))
+        for (name, file) in files:
+            (future, cleanup) = pool.submit("http://host/", file)
+            checks.append((name, future.result() == expected))
+            cleanup()
+    finally:
+        pool.shutdown()
+        os.unlink(filename)
+    for (name, ok) in checks:
+        print("%s: %s" % (name, ok))
+    return all([ok for (_, ok) in checks])
+
+
+
+if __name__ == "__main__":
+    (parser, a) = ioutils.init_opts("<file>+ | --test")
+    a("--procs", type="int", metavar="<n>", dest="procs", help="Parse on n processes")
+    a("--test", action="store_true", help="Run parsepool testsuite")
+    (opts, args) = ioutils.parse_args(parser)
+    if opts.test:
+        sys.exit(not testsuite())
+    if not args:
+        ioutils.opts_help(None, None, None, parser)
+    pool = ParsePool(opts.procs or os.cpu_count() or 1)
+    t = time.time()
+    jobs = []
+    for filename in args:
+        with open(filename, 'rb') as f:
+            jobs.append(pool.submit("http://localhost/", f))
+    (urls, errors) = (0, 0)
+    for (future, cleanup) in jobs:
+        try:
+            urls += len(future.result())
+        except ValueError:
+            errors += 1
+        cleanup()
+    pool.shutdown()
+    print("%s urls in %.2fs, %s documents failed" % (urls, time.time() - t, errors))
+    sys.stderr.write("Parse pool: %s\n" % pool.stats())
+    if spider.truncated:
+        sys.stderr.write("Pages cut short: %s\n" % spider.truncated.stats())
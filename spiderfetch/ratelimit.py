@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+from spiderfetch import ioutils
+
+
+class TokenBucket(object):
+    """Holds up to burst tokens, refilled at rate tokens per second. Tokens
+    can be taken on credit, the debt then has to be waited off."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        t = time.time()
+        self.tokens = min(self.burst, self.tokens + (t - self.stamp) * self.rate)
+        self.stamp = t
+
+    def delay(self, n=1):
+        """Seconds until n tokens are available"""
+        with self.lock:
+            self.refill()
+            if self.tokens >= n:
+                return 0
+            return (n - self.tokens) / self.rate
+
+    def take(self, n=1):
+        """Take n tokens, returns how long to wait to pay off any debt"""
+        with self.lock:
+            self.refill()
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+def parse_rate(s):
+    """Parse a rate like 2.5, 200k or 1m"""
+    try:
+        return ioutils.parse_size(s)
+    except ValueError:
+        raise ValueError("Bad rate: %s" % s)
+
+
+class RateLimiter(object):
+    """Requests per second and bytes per second, each limited both overall and
+    per host. A host that is out of tokens only holds up its own requests."""
+
+    # name -> env var, the names are also the keys to use in recipe rules
+    settings = {"rate": "RATE",
+                "host_rate": "HOST_RATE",
+                "bandwidth": "BANDWIDTH",
+                "host_bandwidth": "HOST_BANDWIDTH"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.requests = None    # global buckets
+        self.bytes = None
+        self.hosts = {}         # host -> (requests bucket, bytes bucket)
+
+    def configure(self, rule=None):
+        """Read the limits from the environment, rules override them"""
+        limits = {}
+        for (name, var) in self.settings.items():
+            value = (rule or {}).get(name) or os.environ.get(var)
+            if value:
+                limits[name] = parse_rate(value)
+
+        # --pause is one request every so many seconds to each host
+        pause = os.environ.get("PAUSE")
+        if pause and not limits.get("host_rate") and float(pause) > 0:
+            limits["host_rate"] = 1 / float(pause)
+
+        with self.lock:
+            if limits == self.limits:
+                return
+            self.limits = limits
+            self.requests = self.new_bucket("rate", burst=1)
+            self.bytes = self.new_bucket("bandwidth")
+            self.hosts = {}
+
+    def new_bucket(self, name, burst=None):
+        rate = self.limits.get(name)
+        if rate:
+            return TokenBucket(rate, burst=burst)
+
+    def get_buckets(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = (self.new_bucket("host_rate", burst=1),
+                                    self.new_bucket("host_bandwidth"))
+            (host_requests, host_bytes) = self.hosts[host]
+            return (self.requests, host_requests), (self.bytes, host_bytes)
+
+    def request_delay(self, host):
+        """Seconds until a request to host is allowed"""
+        if not self.limits:
+            return 0
+        (buckets, _) = self.get_buckets(host)
+        return max([b.delay() for b in buckets if b] + [0])
+
+    def take_request(self, host):
+        if not self.limits:
+            return 0
+        (buckets, _) = self.get_buckets(host)
+        return max([b.take() for b in buckets if b] + [0])
+
+    def wait_request(self, host):
+        """Block until a request to host is allowed, then count it"""
+        delay = self.request_delay(host)
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.request_delay(host)
+        self.take_request(host)
+
+    def take_bytes(self, host, n):
+        """Count n bytes read from host, returns how long to sleep for"""
+        if not self.limits:
+            return 0
+        (_, buckets) = self.get_buckets(host)
+        return max([b.take(n) for b in buckets if b] + [0])
+
+    def throttle(self, host, n):
+        delay = self.take_bytes(host, n)
+        if delay > 0:
+            time.sleep(delay)
+
+limiter = RateLimiter()
+
+
+
+if __name__ == "__main__":
+    bucket = TokenBucket(10, burst=1)
+    t = time.time()
+    for _ in range(11):
+        time.sleep(bucket.take())
+    print("11 requests at 10/s: %.2fs" % (time.time() - t))
+
+    bucket = TokenBucket(parse_rate("100k"))
+    t = time.time()
+    for _ in range(30):
+        time.sleep(bucket.take(8 * 1024))
+    print("240k at 100k/s: %.2fs" % (time.time() - t))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+# longest we ever wait before trying again, in seconds
+MAX_WAIT = 10 * 60
+
+# consecutive failures that trip a host's breaker, and for how long it then
+# stays open the first time, doubling every time it trips again
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 60
+
+
+def backoff(tries, base, cap=MAX_WAIT):
+    """Seconds to wait after the given number of failed tries: doubles with
+    every try, with jitter so that retries don't all come back at once"""
+    wait = min(cap, base * 2 ** max(tries - 1, 0))
+    return wait / 2. + random.uniform(0, wait / 2.)
+
+
+class RetryQueue(object):
+    """Records waiting to be tried again, in the order they fall due"""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, record, delay):
+        heapq.heappush(self.heap, (time.time() + delay, next(self.counter), record))
+
+    def records(self):
+        return [record for (_, _, record) in sorted(self.heap)]
+
+    def next_due(self):
+        """Seconds until the next record falls due, None if there are none"""
+        if self.heap:
+            return max(self.heap[0][0] - time.time(), 0)
+
+    def pop_due(self):
+        """Take out the records that are due"""
+        t = time.time()
+        records = []
+        while self.heap and self.heap[0][0] <= t:
+            records.append(heapq.heappop(self.heap)[2])
+        return records
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a host that keeps failing. After failures
+    consecutive errors of the kinds in trip_on the breaker opens and the host
+    is left alone for cooldown seconds. Then one request is let through: if
+    that fails too the breaker opens again, for twice as long."""
+
+    def __init__(self, trip_on, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.trip_on = trip_on
+        self.failures = failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+
+        self.counts = {}    # host -> consecutive failures
+        self.opened = {}    # host -> (time opened, cooldown)
+        self.probing = set()
+
+    def update(self, host, error):
+        """Count the outcome of a request to host"""
+        with self.lock:
+            probe = host in self.probing
+            self.probing.discard(host)
+            if error not in self.trip_on:
+                self.counts.pop(host, None)
+                self.opened.pop(host, None)
+                return
+            self.counts[host] = self.counts.get(host, 0) + 1
+            if host in self.opened:
+                # requests that were under way when the breaker opened don't
+                # count, only the one let through after the cooldown does
+                if probe:
+                    cooldown = min(self.opened[host][1] * 2, MAX_WAIT)
+                    self.opened[host] = (time.time(), cooldown)
+            elif self.counts[host] >= self.failures:
+                self.opened[host] = (time.time(), self.cooldown)
+
+    def release(self, host):
+        """The request let through to host came to nothing, let another one
+        through in its place"""
+        with self.lock:
+            self.probing.discard(host)
+
+    def remaining(self, host):
+        """Seconds until the breaker for host lets a request through"""
+        with self.lock:
+            if host not in self.opened:
+                return 0
+            (t, cooldown) = self.opened[host]
+            return max(t + cooldown - time.time(), 0)
+
+    def allow(self, host):
+        """Whether a request to host may go ahead now"""
+        with self.lock:
+            if host not in self.opened:
+                return True
+            (t, cooldown) = self.opened[host]
+            if t + cooldown > time.time() or host in self.probing:
+                return False
+            self.probing.add(host)
+            return True
+
+
+
+if __name__ == "__main__":
+    for tries in range(1, 8):
+        print("try %s: wait %.1fs" % (tries, backoff(tries, 10)))
+
+    breaker = CircuitBreaker(trip_on=["timeout"], failures=3, cooldown=0.2)
+    for _ in range(3):
+        breaker.update("a", "timeout")
+    print("open after 3 timeouts: %s" % (not breaker.allow("a")))
+    print("other hosts unaffected: %s" % breaker.allow("b"))
+    time.sleep(0.2)
+    print("half open after cooldown: %s, %s" % (breaker.allow("a"), breaker.allow("a")))
+    breaker.release("a")
+    print("released probe: %s" % breaker.allow("a"))
+    breaker.update("a", None)
+    print("closed after success: %s" % breaker.allow("a"))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import gzip
+import os
+import re
+import sys
+import zlib
+
+from xml.etree import ElementTree
+
+from spiderfetch import fetch
+from spiderfetch import ioutils
+from spiderfetch import ratelimit
+from spiderfetch import urlrewrite
+from spiderfetch.compat import urlparse
+
+
+# the most a sitemap may hold, uncompressed, and the most sitemaps followed
+# from one site, index loops and all
+MAX_SIZE = 50 * 1024 * 1024
+MAX_SITEMAPS = 1000
+MAX_REDIRECTS = 5
+
+# urls are passed on in batches of this many, big sitemaps hold 50000
+BATCH_SIZE = 1000
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+_robots_sitemap = r"""(?im)^\s*sitemap\s*:\s*(?P<url>\S+)"""
+ROBOTS_SITEMAP = re.compile(_robots_sitemap)
+
+
+class Reader(object):
+    """A file that reads what's in head and then fp, up to max_size bytes"""
+
+    def __init__(self, fp, head=b"", max_size=MAX_SIZE):
+        self.fp = fp
+        self.head = head
+        self.left = max_size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.left
+        size = min(size, self.left)
+        (data, self.head) = (self.head[:size], self.head[size:])
+        if len(data) < size:
+            data += self.fp.read(size - len(data))
+        self.left -= len(data)
+        return data
+
+
+def open_sitemap(fp):
+    """fp, unzipped if it's gzipped, and capped at MAX_SIZE"""
+    head = fp.read(len(GZIP_MAGIC))
+    if head == GZIP_MAGIC:
+        fp.seek(0)
+        (fp, head) = (gzip.GzipFile(fileobj=fp, mode='rb'), b"")
+    return Reader(fp, head)
+
+def get_robots_url(url):
+    return urlparse.urljoin(url, "/robots.txt")
+
+def parse_robots(s):
+    """The sitemaps robots.txt lists"""
+    if not isinstance(s, type(u"")):
+        s = s.decode('utf-8', 'replace')
+    return [m.group('url') for m in ROBOTS_SITEMAP.finditer(s)]
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def parse(fp):
+    """Yields ("url", loc) for the pages in a sitemap and ("sitemap", loc)
+    for the sitemaps in a sitemap index, as it is read. A sitemap can also
+    be text, a url per line."""
+    head = fp.read(512)
+    if not head.lstrip().startswith(b"<"):
+        for line in (head + fp.read()).splitlines():
+            line = line.strip().decode('utf-8', 'replace')
+            if line and not line.startswith("#"):
+                yield ("url", line)
+        return
+
+    # elements are thrown away as soon as they've been read, so a sitemap
+    # of any size takes little memory
+    (path, loc, root) = ([], None, None)
+    try:
+        for (event, elem) in ElementTree.iterparse(Reader(fp, head), ("start", "end")):
+            name = local_name(elem.tag)
+            if event == "start":
+                if root is None:
+                    root = elem
+                path.append(name)
+                continue
+            path.pop()
+            # other namespaces have locs too, in <image:image> for instance
+            if name == "loc" and path and path[-1] in ("url", "sitemap"):
+                loc = (elem.text or "").strip()
+            elif name in ("url", "sitemap"):
+                if loc:
+                    yield (name, loc)
+                loc = None
+                root.clear()
+    except ElementTree.ParseError:
+        # keep what could be read
+        pass
+
+def download(url):
+    """The document at url in a spooled tempfile, None if it couldn't be
+    had"""
+    for _ in range(MAX_REDIRECTS):
+        f = fetch.Fetcher(mode=fetch.Fetcher.FETCH, url=url,
+                          fileobj=ioutils.get_spooledfile())
+        ratelimit.limiter.wait_request(urlrewrite.get_hostname(url))
+        try:
+            f.launch_w_tries()
+        except fetch.ChangedUrlWarning as e:
+            f.fileobj.close()
+            url = next(urlrewrite.rewrite_urls(url, [e.new_url]))
+            continue
+        if f.error:
+            f.fileobj.close()
+            return None
+        f.fileobj.seek(0)
+        return f.fileobj
+
+def walk(url):
+    """Find the urls of the site url is on from its sitemaps: the ones in
+    robots.txt, or /sitemap.xml if there are none. Yields
+    (ref_url, sitemaps, urls) for every document read, where ref_url lists
+    sitemaps and urls, the urls in batches. Sitemap indexes are followed.
+    The first ref_url is url itself, which lists robots.txt."""
+    robots_url = get_robots_url(url)
+    yield (url, [robots_url], [])
+
+    fp = download(robots_url)
+    sitemaps = []
+    if fp:
+        with fp:
+            sitemaps = [urlparse.urljoin(robots_url, u)
+                        for u in parse_robots(Reader(fp).read())]
+    if not sitemaps:
+        sitemaps = [urlparse.urljoin(url, "/sitemap.xml")]
+    yield (robots_url, sitemaps, [])
+
+    queue = collections.deque(sitemaps)
+    seen = set(queue)
+    for _ in range(MAX_SITEMAPS):
+        if not queue:
+            break
+        sitemap_url = queue.popleft()
+        fp = download(sitemap_url)
+        if not fp:
+            continue
+        with fp:
+            (sitemaps, urls) = ([], [])
+            try:
+                for (kind, loc) in parse(open_sitemap(fp)):
+                    if kind == "sitemap":
+                        if loc not in seen:
+                            seen.add(loc)
+                            sitemaps.append(loc)
+                        continue
+                    urls.append(loc)
+                    if len(urls) >= BATCH_SIZE:
+                        yield (sitemap_url, [], urls)
+                        urls = []
+            except (IOError, EOFError, zlib.error):
+                # a broken gzip file, keep what could be read
+                pass
+            queue.extend(sitemaps)
+            yield (sitemap_url, sitemaps, urls)
+
+
+def testsuite():
+    """Parse robots.txt, a sitemap, a gzipped sitemap index and a text
+    sitemap"""
+    import io
+    robots = "User-agent: *\nSitemap: http://host/a.xml\n  sitemap : http://host/b.xml.gz\n"
+    urlset = (b'<?xml version="1.0"?>'
+              b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"'
+              b' xmlns:image="http://www.google.com/schemas/sitemap-image/1.1">'
+              b'<url><loc> http://host/1.html </loc>'
+              b'<image:image><image:loc>http://host/1.jpg</image:loc></image:image></url>'
+              b'<url><loc>http://host/2.html</loc></url></urlset>')
+    index = (b'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+             b'<sitemap><loc>http://host/a.xml</loc></sitemap></sitemapindex>')
+    buf = io.BytesIO()
+    g = gzip.GzipFile(fileobj=buf, mode='wb')
+    g.write(index)
+    g.close()
+    buf.seek(0)
+    text = io.BytesIO(b"# pages\nhttp://host/1.html\n\nhttp://host/2.html\n")
+    checks = [("robots.txt", parse_robots(robots) ==
+               ["http://host/a.xml", "http://host/b.xml.gz"]),
+              ("sitemap", list(parse(open_sitemap(io.BytesIO(urlset)))) ==
+               [("url", "http://host/1.html"), ("url", "http://host/2.html")]),
+              ("gzipped index", list(parse(open_sitemap(buf))) ==
+               [("sitemap", "http://host/a.xml")]),
+              ("text sitemap", list(parse(open_sitemap(text))) ==
+               [("url", "http://host/1.html"), ("url", "http://host/2.html")]),
+              ("cut short", list(parse(open_sitemap(io.BytesIO(urlset[:-30])))) ==
+               [("url", "http://host/1.html")])]
+    for (name, ok) in checks:
+        print("%s: %s" % (name, ok))
+    return all([ok for (_, ok) in checks])
+
+
+
+if __name__ == "__main__":
+    (parser, a) = ioutils.init_opts("<url> | <file> | --test")
+    a("--test", action="store_true", help="Run sitemap testsuite")
+    (opts, args) = ioutils.parse_args(parser)
+    if opts.test:
+        sys.exit(not testsuite())
+    if not args:
+        ioutils.opts_help(None, None, None, parser)
+    if os.path.isfile(args[0]):
+        with open(args[0], 'rb') as f:
+            for (kind, loc) in parse(open_sitemap(f)):
+                print(kind.ljust(8), loc)
+        sys.exit()
+    os.environ["LOGGING"] = str(False)
+    (sitemaps, urls) = (set(), 0)
+    for (ref_url, found, batch) in walk(args[0]):
+        if batch:
+            sitemaps.add(ref_url)
+        urls += len(batch)
+        for u in batch:
+            print(u)
+    sys.stderr.write("%s urls in %s sitemaps\n" % (urls, len(sitemaps)))
@@ -3,13 +3,21 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import codecs
+import mmap
+import os
 import re
+import sys
+import threading
+import time
 import urllib
 
 import ansicolor
 
+from spiderfetch import ftplisting
 from spiderfetch import ioutils
 from spiderfetch import urlrewrite
+from spiderfetch.compat import HTMLParser
 
 
 testcases = """\
@@ -31,45 +39,200 @@ host/path">
 <a href= 14file.pat h >
 """
 
-_link = """(?ims)<\s*a[^>]+href[ ]*=?[ ]*(?P<quot>["'`])(?P<url>.*?)(?P=quot)[^>]*?>"""
+# the repeats are bounded, and a quoted url ends at the first closing quote
+# (the lookahead is not backtracked into), so that a tag that doesn't close
+# or goes on and on costs a bounded amount of backtracking
+_link = """(?ims)<\s*a[^>]{1,2048}href[ ]*=?[ ]*(?P<quot>["'`])(?=(?P<url>.{0,2048}?)(?P=quot))(?P=url)(?P=quot)[^>]{0,2048}?>"""
 LINK = re.compile(_link)
 
-_link_unq = """(?ims)<\s*a[^>]+href=[ ]*(?P<url>[^'">]+?)[ ]*>"""
+_link_unq = """(?ims)<\s*a[^>]{1,2048}href=[ ]*(?P<url>[^'">]{1,2048}?)[ ]*>"""
 LINK_UNQ = re.compile(_link_unq)
 
-_frame = """(?ims)<\s*i?frame[^>]+src[ ]*=?[ ]*(?P<quot>["'`])(?P<url>.*?)(?P=quot)[^>]*?>"""
+_frame = """(?ims)<\s*i?frame[^>]{1,2048}src[ ]*=?[ ]*(?P<quot>["'`])(?=(?P<url>.{0,2048}?)(?P=quot))(?P=url)(?P=quot)[^>]{0,2048}?>"""
 FRAME = re.compile(_frame)
 
-_frame_unq = """(?ims)<\s*i?frame[^>]+src=[ ]*(?P<url>[^'">]+?)[ ]*>"""
+_frame_unq = """(?ims)<\s*i?frame[^>]{1,2048}src=[ ]*(?P<url>[^'">]{1,2048}?)[ ]*>"""
 FRAME_UNQ = re.compile(_frame_unq)
 
-_img = """(?ims)<\s*img[^>]+src[ ]*=?[ ]*(?P<quot>["'`])(?P<url>.*?)(?P=quot)[^>]*?>"""
+_img = """(?ims)<\s*img[^>]{1,2048}src[ ]*=?[ ]*(?P<quot>["'`])(?=(?P<url>.{0,2048}?)(?P=quot))(?P=url)(?P=quot)[^>]{0,2048}?>"""
 IMG = re.compile(_img)
 
-_img_unq = """(?ims)<\s*img[^>]+src=[ ]*(?P<url>[^'">]+?)[ ]*?>"""
+_img_unq = """(?ims)<\s*img[^>]{1,2048}src=[ ]*(?P<url>[^'">]{1,2048}?)[ ]*?>"""
 IMG_UNQ = re.compile(_img_unq)
 
 _uri_match = """(?ims)(?P<url>[a-z][a-z0-9+.-]{1,120}:\/\/(([a-z0-9$_.+!*,;\/?:@&~(){}\[\]=-])|%[a-f0-9]{2}){1,333}([a-z0-9][a-z0-9 $_.+!*,;\/?:@&~(){}\[\]=%-]{0,1000})?)"""
 URI_MATCH = re.compile(_uri_match)
 
-#-rw-r--r--    1 1042     1042     28620269 Apr 19  2007 stage1-x86-2007.0.tar.bz2
-_ftp_listing = """.[^ ]{9}(?:\s+[^ ]+){7}\s+(?P<url>.*)$"""
-FTP_LISTING = re.compile(_ftp_listing)
+def _combine():
+    """The tag patterns above in one, for a single scan of the document. At
+    every tag that could be a link they are tried as lookaheads, so each
+    sees the same text it would on its own."""
+    def rename(kind, pattern):
+        pattern = pattern.replace("(?ims)", "")
+        pattern = re.sub(r'\(\?P([<=])(\w+)',
+                         lambda m: "(?P%s%s_%s" % (m.group(1), kind, m.group(2)),
+                         pattern)
+        return pattern
+    # the '<' is left outside the lookaheads, a pattern that starts with a
+    # literal is scanned for much faster
+    tags = "".join(["(?:(?=(?P<%s>%s)))?" % (kind, rename(kind, pattern)[1:])
+                    for (kind, pattern) in _tag_patterns])
+    return "(?ims)<(?=\\s*(?:a|i?frame|img))%s" % tags
 
+# in the order findall() returns their matches
+_tag_patterns = [("link", _link), ("link_unq", _link_unq),
+                 ("frame", _frame), ("frame_unq", _frame_unq),
+                 ("img", _img), ("img_unq", _img_unq)]
+TAGS = re.compile(_combine())
+
+# the start of a uri, looked for only just before a ://
+_uri_scheme = "(?i)[a-z][a-z0-9+.-]{1,120}://"
+URI_SCHEME = re.compile(_uri_scheme)
+
+# the same patterns for bytes, documents are searched in whatever charset
+# they come in and only the urls found are decoded
+TAGS_BYTES = re.compile(_combine().encode('ascii'))
+URI_SCHEME_BYTES = re.compile(_uri_scheme.encode('ascii'))
+URI_MATCH_BYTES = re.compile(_uri_match.encode('ascii'))
+
+_meta_charset = r"""(?i)<meta[^>]+charset\s*=\s*["']?\s*(?P<charset>[a-z0-9_.:-]+)"""
+META_CHARSET = re.compile(_meta_charset.encode('ascii'))
+
+# how far into a document to look for a meta tag with the charset
+CHARSET_SCAN_SIZE = 4 * 1024
+
+# how much of one document is parsed, see Budget
+PARSE_MAX_SIZE = 8 * 1024 * 1024
+PARSE_MAX_URLS = 20000
+PARSE_TIME = 10.0
+
+
+class Truncations(object):
+    """Documents that were cut short, by the limit they ran into. Each one
+    is also logged to truncated_urls, unless log is off."""
+
+    def __init__(self, log=True):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.log = log
+
+    def add(self, limit, url=None):
+        with self.lock:
+            self.counts[limit] = self.counts.get(limit, 0) + 1
+        if self.log and url and os.environ.get("LOGGING") == str(True):
+            ioutils.savelog("%s  %s\n" % (limit.ljust(5), url), "truncated_urls", "a")
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def stats(self):
+        return ", ".join(["%s over %s" % (self.counts[limit], limit)
+                          for limit in sorted(self.counts)])
+
+truncated = Truncations()
+
+class Budget(object):
+    """How much more of a document may be parsed. Past max_size bytes the
+    rest of the document is skipped, past max_urls urls or max_time seconds
+    spent parsing it parsing stops, so that no page, however big or however
+    badly it makes the patterns backtrack, holds up a worker for long. The
+    limits default to $PARSE_MAX_SIZE, $PARSE_MAX_URLS and $PARSE_TIME, 0
+    turns one off. Ftp listings have no limits, cutting one short would lose
+    files, not just links."""
+
+    def __init__(self, url=None, max_size=None, max_urls=None, max_time=None):
+        self.url = url
+        if url and urlrewrite.get_scheme(url) == "ftp":
+            (max_size, max_urls, max_time) = (0, 0, 0)
+        env = os.environ.get
+        if max_size is None:
+            max_size = int(ioutils.parse_size(env("PARSE_MAX_SIZE") or PARSE_MAX_SIZE))
+        if max_urls is None:
+            max_urls = int(env("PARSE_MAX_URLS") or PARSE_MAX_URLS)
+        if max_time is None:
+            max_time = float(env("PARSE_TIME") or PARSE_TIME)
+        (self.max_size, self.max_urls, self.max_time) = (max_size, max_urls, max_time)
+        self.size = 0
+        self.urls = 0
+        self.spent = 0.0
+        self.started = None
+        # the limits reached, the first is the one the document is counted by
+        self.exceeded = []
+
+    def exceed(self, limit):
+        if not self.exceeded:
+            truncated.add(limit, self.url)
+        if limit not in self.exceeded:
+            self.exceeded.append(limit)
+
+    def take(self, s):
+        """The part of s, the next piece of the document, within the size
+        limit"""
+        if self.max_size and self.size + len(s) > self.max_size:
+            s = s[:max(0, self.max_size - self.size)]
+            self.exceed("size")
+        self.size += len(s)
+        return s
+
+    def start(self):
+        self.started = time.time()
+
+    def stop(self):
+        if self.started is not None:
+            self.spent += time.time() - self.started
+            self.started = None
+
+    def expired(self):
+        """Whether to stop parsing. Checked between matches, a match that
+        has started can't be interrupted."""
+        spent = self.spent
+        if self.started is not None:
+            spent += time.time() - self.started
+        if self.max_time and spent > self.max_time:
+            self.exceed("time")
+        return "time" in self.exceeded or "urls" in self.exceeded
+
+    def spend(self, urls):
+        """The urls found within the url limit"""
+        if self.max_urls and self.urls + len(urls) > self.max_urls:
+            urls = urls[:max(0, self.max_urls - self.urls)]
+            self.exceed("urls")
+        self.urls += len(urls)
+        return urls
 
 def find_with_r(r, s):
     if type(s) is bytes:
-        s = s.decode()
+        s = s.decode('utf-8', 'replace')
     return re.finditer(r, s)
 
+def get_charset(content_type=None, data=None, default="utf-8"):
+    """The charset of a document, from a byte order mark at the start of
+    data, the Content-Type header or a meta tag in data, in that order.
+    Only charsets that leave ascii alone are any use to the byte patterns."""
+    candidates = []
+    if data and data[:3] == codecs.BOM_UTF8:
+        candidates.append("utf-8")
+    if content_type:
+        m = re.search(r'(?i)charset\s*=\s*["\']?([a-z0-9_.:-]+)', content_type)
+        if m:
+            candidates.append(m.group(1))
+    if data:
+        m = META_CHARSET.search(data[:CHARSET_SCAN_SIZE])
+        if m:
+            candidates.append(m.group('charset').decode('ascii'))
+    for charset in candidates:
+        try:
+            name = codecs.lookup(charset).name
+        except LookupError:
+            continue
+        if not name.startswith(("utf-16", "utf-32")):
+            return name
+    return default
+
 def spider_ftp(s):
-    lines = s.splitlines()
-    filler = ""
-    for line in lines:
-        it = re.finditer(FTP_LISTING, filler + line)
-        filler += (2 + len(line)) * " "
-        for match in it:
-            yield match
+    """The names in a directory listing, see ftplisting.parse"""
+    for entry in ftplisting.parse(s):
+        yield entry.match
 
 def spider(s):
     for it in [find_with_r(r, s) for r in (LINK, LINK_UNQ, FRAME, FRAME_UNQ, IMG, IMG_UNQ)]:
@@ -79,6 +242,31 @@ def spider(s):
 def harvest(s):
     return find_with_r(URI_MATCH, s)
 
+def get_patterns(s):
+    """(TAGS, URI_SCHEME, URI_MATCH, "://") to search s with, the bytes ones
+    for anything that isn't text"""
+    if isinstance(s, type(u"")):
+        return (TAGS, URI_SCHEME, URI_MATCH, "://")
+    return (TAGS_BYTES, URI_SCHEME_BYTES, URI_MATCH_BYTES, b"://")
+
+def harvest_fast(s, budget=None):
+    """The same matches as harvest(). Rather than trying URI_MATCH at every
+    letter, which is most of the time spent spidering, jump from one :// to
+    the next and only try it where the scheme before it starts."""
+    (_, uri_scheme, uri_match, sep_str) = get_patterns(s)
+    pos = 0
+    while True:
+        sep = s.find(sep_str, pos)
+        if sep < 0 or (budget and budget.expired()):
+            return
+        m = uri_scheme.search(s, max(pos, sep - 121), sep + 3)
+        m = m and uri_match.match(s, m.start())
+        if m:
+            yield m
+            pos = m.end()
+        else:
+            pos = sep + 1
+
 def findall(s, url=None):
     its = [spider(s), harvest(s)]
     if url and urlrewrite.get_scheme(url) == "ftp":
@@ -91,6 +279,302 @@ def unbox_it_to_ss(it):
     for match in it:
         yield match.group('url')
 
+def extract(s, url=None, charset=None, budget=None):
+    """The urls findall() would find, in the same order. The tags are
+    scanned for once instead of six times. s can be text, or bytes, an mmap
+    or anything else with the buffer interface, in which case the urls are
+    decoded from charset, or the charset the document declares. With a
+    budget the scan stops when it runs out of time or urls, s should have
+    been through budget.take() already."""
+    if not budget:
+        return _extract(s, url, charset)
+    if budget.expired():
+        return []
+    budget.start()
+    try:
+        return budget.spend(_extract(s, url, charset, budget))
+    finally:
+        budget.stop()
+
+def _extract(s, url=None, charset=None, budget=None):
+    if isinstance(s, memoryview):
+        s = s.tobytes()
+    (tags, _, _, _) = get_patterns(s)
+    if isinstance(s, type(u"")):
+        decode = lambda u: u
+    else:
+        charset = charset or get_charset(None, s[:CHARSET_SCAN_SIZE])
+        decode = lambda u: u.decode(charset, 'replace')
+    kinds = [kind for (kind, _) in _tag_patterns]
+    found = dict([(kind, []) for kind in kinds])
+    # where the last match of each pattern ended, the matches of a pattern
+    # on its own don't overlap
+    ends = dict([(kind, -1) for kind in kinds])
+    for m in tags.finditer(s):
+        if budget and budget.expired():
+            break
+        for kind in kinds:
+            if m.start() >= ends[kind] and m.group(kind) is not None:
+                found[kind].append(m.group(kind + "_url"))
+                ends[kind] = m.end(kind)
+    urls = []
+    for kind in kinds:
+        urls.extend(found[kind])
+    urls.extend(unbox_it_to_ss(harvest_fast(s, budget)))
+    urls = [decode(u) for u in urls]
+    if url and urlrewrite.get_scheme(url) == "ftp":
+        if not isinstance(s, type(u"")):
+            s = decode(s[:])
+        for entry in ftplisting.parse(s):
+            if budget and budget.expired():
+                break
+            # directories with a slash, so they're listed rather than fetched
+            urls.append(entry.get_url())
+    return urls
+
+def extract_file(filename, url=None, content_type=None, budget=None):
+    """extract() on a file, mapped into memory instead of read"""
+    with open(filename, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            charset = get_charset(content_type, m[:CHARSET_SCAN_SIZE])
+            return extract(budget.take(m) if budget else m, url, charset, budget)
+        finally:
+            m.close()
+
+class Extractor(object):
+    """Finds urls in a document that is fed in chunks as it downloads.
+    Everything after the last complete tag (or line, in ftp listings) is
+    held back until the next chunk, so that a tag split across two chunks
+    is matched whole."""
+
+    # don't hold back more than this waiting for a tag to close
+    max_carry = 64 * 1024
+
+    def __init__(self, url=None):
+        self.reset(url)
+
+    def reset(self, url=None):
+        self.url = url
+        self.urls = []
+        self.carry = b""
+        # taken from the start of the document unless set before then
+        self.charset = None
+        self.budget = Budget(url)
+
+    def extract(self, s):
+        urls = extract(s, self.url, self.charset, self.budget)
+        self.urls.extend(urls)
+        return urls
+
+    def feed(self, data):
+        """Returns the urls found in what could be matched so far"""
+        if isinstance(data, type(u"")):
+            data = data.encode(self.charset or "utf-8")
+        s = self.carry + self.budget.take(data)
+        if self.charset is None:
+            # hold on to the start of the document until it's clear what
+            # charset it declares, if any
+            if len(s) < CHARSET_SCAN_SIZE:
+                self.carry = s
+                return []
+            self.charset = get_charset(None, s[:CHARSET_SCAN_SIZE])
+        if self.url and urlrewrite.get_scheme(self.url) == "ftp":
+            cut = s.rfind(b"\n") + 1
+        else:
+            cut = s.rfind(b">") + 1
+        if not cut and len(s) > self.max_carry:
+            cut = len(s)
+        (s, self.carry) = (s[:cut], s[cut:])
+        return self.extract(s)
+
+    def close(self):
+        (s, self.carry) = (self.carry, b"")
+        return self.extract(s)
+
+def benchmark(docs, rounds=3):
+    """Time findall() against extract() over docs, which are bytes, and
+    check that they agree. extract() is timed on the text and on the bytes."""
+    def best(func, docs):
+        times = []
+        for _ in range(rounds):
+            t = time.time()
+            for doc in docs:
+                func(doc)
+            times.append(time.time() - t)
+        return min(times)
+    texts = [doc.decode('utf-8', 'replace') for doc in docs]
+    mismatches = [i for (i, (doc, text)) in enumerate(zip(docs, texts))
+                  if not list(unbox_it_to_ss(findall(text))) == extract(text) == extract(doc)]
+    size = sum([len(doc) for doc in docs]) / 1024. / 1024
+    print("%s documents, %.1f MB, %s urls" %
+          (len(docs), size, sum([len(extract(doc)) for doc in docs])))
+    t_findall = best(lambda doc: list(unbox_it_to_ss(findall(doc))), texts)
+    print("findall          %.3fs  %.1f MB/s" % (t_findall, size / t_findall))
+    for (name, func, inputs) in (("extract (text)", extract, texts),
+                                 ("extract (bytes)", extract, docs)):
+        t = best(func, inputs)
+        print("%s  %.3fs  %.1f MB/s  %.2fx" %
+              (name.ljust(15), t, size / t, t_findall / t))
+    print("mismatches: %s" % len(mismatches))
+    return not mismatches
+
+class HtmlExtractor(object):
+    """An Extractor that tokenizes the document with html.parser instead of
+    matching patterns over it. Links are the href of a and area tags and the
+    src of frames and images, absolute urls are picked out of the other
+    attributes, text and comments. Entities in attributes are decoded."""
+
+    links = {"a": "href", "area": "href",
+             "frame": "src", "iframe": "src", "img": "src"}
+
+    class Parser(HTMLParser):
+        def __init__(self, extractor):
+            HTMLParser.__init__(self)
+            self.extractor = extractor
+            # text can come in pieces, split wherever a chunk ended
+            self.text = []
+
+        def harvest(self, s):
+            if "://" in s:
+                self.extractor.found.extend(
+                    unbox_it_to_ss(harvest_fast(s, self.extractor.budget)))
+
+        def flush_text(self):
+            if self.text:
+                (s, self.text) = ("".join(self.text), [])
+                self.harvest(s)
+
+        def handle_starttag(self, tag, attrs):
+            self.flush_text()
+            attr = self.extractor.links.get(tag)
+            for (name, value) in attrs:
+                if not value:
+                    continue
+                if name == attr:
+                    self.extractor.found.append(value.strip())
+                else:
+                    self.harvest(value)
+
+        def handle_startendtag(self, tag, attrs):
+            self.handle_starttag(tag, attrs)
+
+        def handle_endtag(self, tag):
+            self.flush_text()
+
+        def handle_data(self, data):
+            self.text.append(data)
+
+        def handle_comment(self, data):
+            self.flush_text()
+            self.harvest(data)
+
+        def close(self):
+            HTMLParser.close(self)
+            self.flush_text()
+
+    def __init__(self, url=None):
+        self.reset(url)
+
+    def reset(self, url=None):
+        self.url = url
+        self.urls = []
+        self.found = []
+        self.parser = self.Parser(self)
+        self.charset = None
+        self.decoder = None
+        self.head = b""
+        self.budget = Budget(url)
+
+    def collect(self):
+        (urls, self.found) = (self.budget.spend(self.found), [])
+        self.urls.extend(urls)
+        return urls
+
+    def parse(self, data):
+        if not self.budget.expired():
+            self.budget.start()
+            try:
+                self.parser.feed(data)
+            finally:
+                self.budget.stop()
+
+    def feed(self, data):
+        """Returns the urls found in what could be parsed so far"""
+        data = self.budget.take(data)
+        if not isinstance(data, type(u"")):
+            if not self.decoder:
+                # see Extractor.feed
+                self.head += data
+                if self.charset is None and len(self.head) < CHARSET_SCAN_SIZE:
+                    return []
+                (data, self.head) = (self.head, b"")
+                self.start_decoding()
+            data = self.decoder.decode(bytes(data))
+        self.parse(data)
+        return self.collect()
+
+    def start_decoding(self):
+        self.charset = self.charset or get_charset(None, self.head)
+        self.decoder = codecs.getincrementaldecoder(self.charset)('replace')
+
+    def close(self):
+        if self.head:
+            self.start_decoding()
+            self.parse(self.decoder.decode(self.head))
+        if self.decoder:
+            self.parse(self.decoder.decode(b'', True))
+        if not self.budget.expired():
+            self.parser.close()
+        return self.collect()
+
+# extraction engines, by name
+engines = {"regex": Extractor, "html": HtmlExtractor}
+
+def get_extractor(url=None):
+    """An extractor of the kind in $PARSER, regex by default. Ftp listings
+    are always matched with the regexes."""
+    name = os.environ.get("PARSER") or "regex"
+    if name not in engines:
+        raise ValueError("No such parser: %s" % name)
+    if url and urlrewrite.get_scheme(url) == "ftp":
+        name = "regex"
+    return engines[name](url)
+
+def run_engine(name, doc, chunk_size=16 * 1024):
+    """All the urls engine name finds in doc, fed to it in chunks"""
+    extractor = engines[name]()
+    for i in range(0, len(doc), chunk_size):
+        extractor.feed(doc[i:i + chunk_size])
+    extractor.close()
+    return extractor.urls
+
+def compare(docs, rounds=3):
+    """Time the engines on docs and report the urls they don't agree on"""
+    size = sum([len(doc) for doc in docs]) / 1024. / 1024
+    results = {}
+    for name in sorted(engines):
+        times = []
+        for _ in range(rounds):
+            t = time.time()
+            results[name] = [run_engine(name, doc) for doc in docs]
+            times.append(time.time() - t)
+        urls = sum([len(set(urls)) for urls in results[name]])
+        print("%s  %.3fs  %.1f MB/s  %s urls" %
+              (name.ljust(6), min(times), size / min(times), urls))
+    names = sorted(engines)
+    for (i, other) in enumerate(names):
+        for name in names[:i]:
+            for (a, b) in ((name, other), (other, name)):
+                only = [set(x) - set(y)
+                        for (x, y) in zip(results[a], results[b])]
+                print("only %s: %s urls in %s documents" %
+                      (a, sum([len(s) for s in only]), len([s for s in only if s])))
+                for s in [s for s in only if s][:3]:
+                    print("  %s" % " ".join(sorted(s)[:3]))
+
 def group_by_regex(s, url=None):
     its = [spider(s), harvest(s)]
     if url and urlrewrite.get_scheme(url) == "ftp":
@@ -126,20 +610,34 @@ def colorize_shell(str, url=None):
 
 
 if __name__ == "__main__":
-    (parser, a) = ioutils.init_opts("[ <url|file> [options] | --test ]")
+    (parser, a) = ioutils.init_opts("[ <url|file> [options] | --test | --bench|--compare <file>+ ]")
     a("--dump", action="store_true", help="Dump urls")
     a("--test", action="store_true", help="Run spider testsuite")
+    a("--bench", action="store_true", help="Time findall against extract on <file>+")
+    a("--compare", action="store_true", help="Compare the engines on <file>+")
     (opts, args) = ioutils.parse_args(parser)
     try:
         url = None
+        if (opts.bench or opts.compare) and args:
+            docs = []
+            for filename in args:
+                with open(filename, 'rb') as f:
+                    docs.append(f.read())
+            if opts.compare:
+                sys.exit(compare(docs))
+            sys.exit(not benchmark(docs))
         if opts.test:
             data = testcases
+        elif opts.dump and os.path.isfile(args[0]):
+            for u in unique(extract_file(args[0])):
+                print(u)
+            sys.exit()
         else:
             url = args[0]
             data = urllib.request.urlopen(url).read()
 
         if opts.dump:
-            for u in unique(unbox_it_to_ss(findall(data, url))):
+            for u in unique(extract(data, url)):
                 print(u)
         else:
             print(colorize_shell(data, url))
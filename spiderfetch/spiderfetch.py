@@ -4,20 +4,31 @@
 
 from __future__ import absolute_import
 
+import collections
 import os
 import shutil
 import sys
+import threading
 import traceback
 import time
 
 import ansicolor
 
+from spiderfetch import connpool
+from spiderfetch import dnscache
 from spiderfetch import fetch
+from spiderfetch import filetype
 from spiderfetch import ioutils
+from spiderfetch import manifest
+from spiderfetch import parsepool
+from spiderfetch import ratelimit
 from spiderfetch import recipe
+from spiderfetch import retry
+from spiderfetch import sitemap
 from spiderfetch import spider
 from spiderfetch import urlrewrite
 from spiderfetch import web
+from spiderfetch import workerpool
 
 
 class Session(object):
@@ -73,14 +84,29 @@ class SpiderFetcher(object):
     def __init__(self, session):
         self.session = session
 
-    def log_exc(self, exc, url):
+        # guards session.wb, which worker threads touch when following redirects
+        self.lock = threading.RLock()
+
+        # remembers which kinds of urls turned out not to be worth spidering
+        self.prober = filetype.Prober()
+
+        # failed records wait here to be tried again, while hosts that keep
+        # failing are left alone for a while
+        self.retries = retry.RetryQueue()
+        self.breaker = retry.CircuitBreaker(
+            trip_on=(fetch.err.timeout, fetch.err.http_503, fetch.err.dns))
+
+    def log_exc(self, exc, url, tb=None):
+        """Log exc, tb is its traceback if it's not being handled on this
+        thread"""
         exc_filename = ioutils.safe_filename("exc", dir=ioutils.LOGDIR)
         ioutils.serialize(exc, exc_filename, dir=ioutils.LOGDIR)
-        s = traceback.format_exc()
+        s = tb or traceback.format_exc()
         s += "\nBad url:   |%s|\n" % url
-        node = self.session.wb.get(url)
-        for u in node.incoming.keys():
-            s += "Ref    :   |%s|\n" % u
+        with self.lock:
+            node = self.session.wb.get(url)
+            for u in node.incoming.keys():
+                s += "Ref    :   |%s|\n" % u
         s += "Exception object serialized to file: %s\n\n" % exc_filename
         ioutils.savelog(s, "error_log", "a")
 
@@ -92,15 +118,19 @@ class SpiderFetcher(object):
                 fetcher.launch_w_tries()
                 break
             except fetch.ChangedUrlWarning as e:
-                url = urlrewrite.rewrite_urls(fetcher.url, [e.new_url]).next()
-                if url in self.session.wb:
-                    raise fetch.DuplicateUrlWarning
-                if not recipe.apply_hostfilter(host_filter, url):
-                    raise fetch.UrlRedirectsOffHost
-                self.session.wb.add_ref(fetcher.url, url)
-                fetcher.url = url
+                fetcher.url = self.follow_redirect(fetcher.url, e.new_url, host_filter)
         return fetcher.url
 
+    def follow_redirect(self, url, new_url, host_filter=False):
+        new_url = next(urlrewrite.rewrite_urls(url, [new_url]))
+        with self.lock:
+            if new_url in self.session.wb:
+                raise fetch.DuplicateUrlWarning
+            if not recipe.apply_hostfilter(host_filter, new_url):
+                raise fetch.UrlRedirectsOffHost
+            self.session.wb.add_ref(url, new_url)
+        return new_url
+
     def qualify_urls(self, ref_url, urls, rule, newqueue):
         for url in urls:
             _dump, _fetch, _spider = False, False, False
@@ -128,6 +158,7 @@ class SpiderFetcher(object):
 
                 if _fetch or _spider:
                     newqueue.append(record)
+                    dnscache.prefetch(url)
 
             # add url to web if it was matched by anything
             if _dump or _fetch or _spider:
@@ -135,57 +166,198 @@ class SpiderFetcher(object):
 
         return newqueue
 
-    def process_records(self, rule):
-        newqueue = []
-        for record in self.session.queue:
-            self.session.maybe_save()
-
-            url = record.get("url")
+    def new_fetcher(self, record, cls=fetch.Fetcher):
+        # pages to spider are small, keep them in memory and find the urls
+        # in them as they come in
+        if record.get("mode") == fetch.Fetcher.SPIDER:
+            f = cls(mode=record.get("mode"), url=record.get("url"),
+                    fileobj=ioutils.get_spooledfile())
+            if not parsepool.get_pool():
+                f.extractor = spider.get_extractor(f.url)
+        # files go where a later run will find them if this one is cut short
+        elif record.get("mode") == fetch.Fetcher.FETCH:
+            f = cls(mode=record.get("mode"), url=record.get("url"),
+                    filename=ioutils.get_partfile(record.get("url")))
+        else:
+            (fp, filename) = ioutils.get_tempfile()
+            os.close(fp)
+            f = cls(mode=record.get("mode"), url=record.get("url"), filename=filename)
+        f.prober = self.prober
+        # retries are scheduled by process_fetched instead of waited out
+        f.tries = 1
+        # the breaker is kept for the host asked for, redirects or not
+        f.breaker_host = urlrewrite.get_hostname(f.url)
+        return f
+
+    def blocked(self, f):
+        """Fail the fetch up front if the breaker for its host is open"""
+        if self.breaker.allow(f.breaker_host):
+            return False
+        f.handle_error(fetch.err.host_down)
+        return True
+
+    def discard(self, f):
+        if f.fileobj:
+            f.fileobj.close()
+        # keep partial downloads that can be resumed
+        elif not (f.mode == fetch.Fetcher.FETCH and
+                  manifest.Manifest.exists(f.filename)):
+            for path in (f.filename, manifest.Manifest.get_path(f.filename)):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def abandon(self, f, exc=None, tb=None):
+        self.breaker.release(f.breaker_host)
+        if exc and not isinstance(exc, (fetch.DuplicateUrlWarning,
+                                        fetch.UrlRedirectsOffHost)):
+            self.log_exc(exc, f.url, tb)
+        self.discard(f)
+
+    def submit_parse(self, f):
+        """Send a spidered document to the parse pool, if there is one.
+        Returns (future, cleanup) like ParsePool.submit, or None."""
+        pool = parsepool.get_pool()
+        if pool and f.mode == fetch.Fetcher.SPIDER and not f.error:
+            charset = spider.get_charset(f.content_type, f.header)
+            return pool.submit(f.url, f.fileobj or f.filename, charset)
+
+    def parse(self, f):
+        job = self.submit_parse(f)
+        if job:
+            (future, cleanup) = job
             try:
-                (fp, filename) = ioutils.get_tempfile()
-                f = fetch.Fetcher(mode=record.get("mode"), url=url, filename=filename)
-                url = self.get_url(f, host_filter=rule.get("host_filter"))
-                filename = f.filename
-
-                # consider retrying the fetch if it failed
-                if f.error and fetch.err.is_temporal(f.error):
-                    if not record.get("retry"):
-                        record["retry"] = True
-                        self.session.queue.append(record)
-
-                if record.get("mode") == fetch.Fetcher.SPIDER:
-                    data = open(filename, 'r').read()
-                    urls = spider.unbox_it_to_ss(spider.findall(data, url))
-                    urls = urlrewrite.rewrite_urls(url, urls)
-
-                    newqueue = self.qualify_urls(url, urls, rule, newqueue)
-
-                if record.get("mode") == fetch.Fetcher.FETCH:
-                    shutil.move(filename,
-                                ioutils.safe_filename(urlrewrite.url_to_filename(url)))
-
-            except (fetch.DuplicateUrlWarning, fetch.UrlRedirectsOffHost):
-                pass
-            except KeyboardInterrupt:
-                q = self.session.queue[self.session.queue.index(record):]
-                q.extend(newqueue)
-                self.session.queue = q
-                self.session.save()
-                sys.exit(1)
-            except Exception as exc:
-                self.log_exc(exc, url)
+                f.urls = future.result()
             finally:
-                try:
-                    if filename and os.path.exists(filename):
-                        os.unlink(filename)
-                    if fp:
-                        os.close(fp)
-                except (NameError, OSError):
-                    pass
+                cleanup()
+
+    def fetch_record(self, record, rule):
+        """Fetch a record into a tempfile, may run on a worker thread. Returns
+        the fetcher, or None if the record was abandoned."""
+        f = self.new_fetcher(record)
+        if self.blocked(f):
+            return f
+        try:
+            self.get_url(f, host_filter=rule.get("host_filter"))
+            self.parse(f)
+            return f
+        except Exception as exc:
+            self.abandon(f, exc)
+        except KeyboardInterrupt:
+            self.abandon(f)
+            raise
+
+    def fetch_records(self, rule):
+        """Yields (record, fetcher) as fetches complete. Records scheduled
+        for a retry in the meantime are fetched too, once they fall due."""
+        engine = os.environ.get("ENGINE")
+        workers = int(os.environ.get("WORKERS") or 1)
+        if workers < 2 and not engine == "asyncio":
+            queue = collections.deque(self.session.queue)
+            while queue or self.retries:
+                records = self.retries.pop_due()
+                if not records and queue:
+                    records = [queue.popleft()]
+                if not records:
+                    time.sleep(self.retries.next_due())
+                for record in records:
+                    with self.lock:
+                        self.session.maybe_save()
+                    ratelimit.limiter.wait_request(urlrewrite.get_hostname(record.get("url")))
+                    yield record, self.fetch_record(record, rule)
+            return
+
+        host_conns = int(os.environ.get("HOST_CONNS") or 0)
+        if engine == "asyncio":
+            from spiderfetch import aiofetch
+            pool = aiofetch.AsyncPool(lambda r: aiofetch.fetch_record(self, r, rule),
+                                      workers, host_conns=host_conns,
+                                      limiter=ratelimit.limiter)
+        else:
+            pool = workerpool.WorkerPool(lambda r: self.fetch_record(r, rule),
+                                         workers, host_conns=host_conns,
+                                         limiter=ratelimit.limiter)
+        pool.start()
+        try:
+            for record in self.session.queue:
+                pool.submit(record)
+            while pool or self.retries:
+                for record in self.retries.pop_due():
+                    pool.submit(record)
+                with self.lock:
+                    self.session.maybe_save()
+                if not pool:
+                    time.sleep(self.retries.next_due())
+                    continue
+                result = pool.get(timeout=self.retries.next_due())
+                if result:
+                    yield result
+        finally:
+            pool.stop()
+
+    def process_fetched(self, record, f, rule, newqueue):
+        url = f.url
+        filename = f.filename
+
+        # consider retrying the fetch if it failed
+        host = f.breaker_host
+        if not f.error == fetch.err.host_down:
+            self.breaker.update(host, f.error)
+        if f.error and fetch.err.is_temporal(f.error):
+            self.schedule_retry(record, host)
+
+        # the same page under another url, its links have been seen
+        digest = not f.error and f.content_hash()
+        if digest:
+            with self.lock:
+                orig = self.session.wb.add_hash(url, digest)
+            if orig:
+                return newqueue
+
+        if record.get("mode") == fetch.Fetcher.SPIDER:
+            urls = f.urls or []
+            if f.extractor:
+                urls = urlrewrite.rewrite_urls(url, f.extractor.urls)
+
+            with self.lock:
+                newqueue = self.qualify_urls(url, urls, rule, newqueue)
+
+        if record.get("mode") == fetch.Fetcher.FETCH:
+            shutil.move(filename,
+                        ioutils.safe_filename(urlrewrite.url_to_filename(url)))
+
+        return newqueue
 
-            pause = os.environ.get('PAUSE')
-            if pause:
-                time.sleep(int(pause))
+    def schedule_retry(self, record, host):
+        tries = record.get("tries", 1)
+        if tries < int(os.environ.get("TRIES") or 2):
+            record["tries"] = tries + 1
+            delay = max(retry.backoff(tries, fetch.RETRY_WAIT),
+                        self.breaker.remaining(host))
+            self.retries.schedule(record, delay)
+
+    def process_records(self, rule):
+        newqueue = []
+        done = set()
+        ratelimit.limiter.configure(rule)
+        try:
+            for (record, f) in self.fetch_records(rule):
+                try:
+                    if f:
+                        newqueue = self.process_fetched(record, f, rule, newqueue)
+                except Exception as exc:
+                    self.log_exc(exc, f.url)
+                finally:
+                    done.add(id(record))
+                    if f:
+                        self.discard(f)
+        except KeyboardInterrupt:
+            q = [r for r in self.session.queue if id(r) not in done]
+            q.extend(self.retries.records())
+            q.extend(newqueue)
+            self.session.queue = q
+            with self.lock:
+                self.session.save()
+            sys.exit(1)
 
         return newqueue
 
@@ -206,6 +378,23 @@ class SpiderFetcher(object):
                     spider_queue.append(r)
         return fetch_queue, spider_queue
 
+    def seed(self, url):
+        """Queue the urls in the sitemaps of url's site, qualified by the
+        first rule, before spidering starts"""
+        rule = self.session.rules[0]
+        ratelimit.limiter.configure(rule)
+        (queue, found) = (self.session.queue, 0)
+        queued = len(queue)
+        for (ref_url, sitemaps, urls) in sitemap.walk(url):
+            found += len(urls)
+            with self.lock:
+                # sitemaps go in the web so they're not spidered as pages
+                self.session.wb.add_url(ref_url, sitemaps)
+                queue = self.qualify_urls(ref_url, urls, rule, queue)
+        self.session.queue = queue
+        ioutils.write_err("Sitemaps: %s urls, %s queued\n" %
+                          (found, len(queue) - queued))
+
     def main(self):
         outer_queue = self.session.queue
         for rule in self.session.rules:
@@ -230,6 +419,18 @@ class SpiderFetcher(object):
 
         self.session.save()
 
+        if connpool.pool.hits or connpool.pool.misses:
+            ioutils.write_err("Connection pool: %s\n" % connpool.pool.stats())
+        if connpool.ftp_pool.hits or connpool.ftp_pool.misses:
+            ioutils.write_err("Ftp logins: %s\n" % connpool.ftp_pool.stats())
+        if dnscache.cache:
+            ioutils.write_err("DNS cache: %s\n" % dnscache.cache.stats())
+        if parsepool.pool:
+            ioutils.write_err("Parse pool: %s\n" % parsepool.pool.stats())
+            parsepool.pool.shutdown()
+        if spider.truncated:
+            ioutils.write_err("Pages cut short: %s\n" % spider.truncated.stats())
+
 
 def run_script():
     (parser, a) = ioutils.init_opts("<url> ['<pattern>'] [options]")
@@ -238,7 +439,31 @@ def run_script():
     a("--dump", action="store_true", help="Dump urls, don't fetch")
     a("--host", action="store_true", help="Only spider this host")
     a("--pause", type="int", metavar="<pause>", dest="pause", help="Pause for x seconds between requests")
+    a("--rate", metavar="<n>", dest="rate", help="Make at most n requests per second")
+    a("--host-rate", metavar="<n>", dest="host_rate",
+      help="Make at most n requests per second to the same host")
+    a("--bandwidth", metavar="<n>", dest="bandwidth",
+      help="Download at most n bytes per second (eg. 500k, 2m)")
+    a("--host-bandwidth", metavar="<n>", dest="host_bandwidth",
+      help="Download at most n bytes per second from the same host")
     a("--depth", type="int", metavar="<depth>", dest="depth", help="Spider to this depth")
+    a("--workers", type="int", metavar="<n>", dest="workers", help="Fetch up to n urls at a time")
+    a("--host-conns", type="int", metavar="<n>", dest="host_conns",
+      help="Fetch up to n urls at a time from the same host (default %s)" %
+      workerpool.HOST_CONNS)
+    a("--segments", type="int", metavar="<n>", dest="segments",
+      help="Fetch large files as n parallel byte ranges")
+    a("--cache", metavar="<dir>", dest="cache", help="Cache pages in <dir> and revalidate them")
+    a("--probe", action="store_true",
+      help="Send HEAD requests to find urls that aren't worth spidering")
+    a("--engine", type="choice", choices=["urllib", "asyncio"], metavar="<engine>",
+      dest="engine", help="Fetch engine to use: urllib (default) or asyncio")
+    a("--parser", type="choice", choices=sorted(spider.engines), metavar="<parser>",
+      dest="parser", help="Find urls with: regex (default) or html")
+    a("--parse-procs", type="int", metavar="<n>", dest="parse_procs",
+      help="Find urls in pages on n processes")
+    a("--sitemaps", action="store_true",
+      help="Start with the urls in the site's sitemaps")
     (opts, args) = ioutils.parse_args(parser)
     try:
         if opts.fetch:
@@ -249,8 +474,29 @@ def run_script():
             os.environ["HOST_FILTER"] = "1"
         if opts.pause:
             os.environ["PAUSE"] = str(opts.pause)
+        for (name, var) in ratelimit.RateLimiter.settings.items():
+            if getattr(opts, name):
+                os.environ[var] = getattr(opts, name)
         if opts.depth:
             os.environ["DEPTH"] = str(opts.depth)
+        if opts.workers:
+            os.environ["WORKERS"] = str(opts.workers)
+        if opts.host_conns:
+            os.environ["HOST_CONNS"] = str(opts.host_conns)
+        if opts.segments:
+            os.environ["SEGMENTS"] = str(opts.segments)
+        if opts.cache:
+            os.environ["CACHE_DIR"] = opts.cache
+        if opts.probe:
+            os.environ["PROBE"] = "1"
+        if opts.engine:
+            os.environ["ENGINE"] = opts.engine
+        if opts.parser:
+            os.environ["PARSER"] = opts.parser
+        if opts.parse_procs:
+            os.environ["PARSE_PROCS"] = str(opts.parse_procs)
+        if opts.sitemaps:
+            os.environ["SITEMAPS"] = "1"
 
         url = args[0]
         if opts.recipe:
@@ -262,6 +508,8 @@ def run_script():
         session = Session.restore(url)
         session.rules = rules
 
+        # a resumed session was seeded the first time around
+        seed = session.queue is None and os.environ.get("SITEMAPS")
         if session.queue is None:
             session.queue = recipe.get_queue(url, mode=fetch.Fetcher.SPIDER)
         if session.wb is None:
@@ -274,6 +522,12 @@ def run_script():
         ioutils.opts_help(None, None, None, parser)
 
     spiderfetcher = SpiderFetcher(session)
+    if seed:
+        try:
+            spiderfetcher.seed(url)
+        except KeyboardInterrupt:
+            ioutils.write_abort()
+            sys.exit(1)
     spiderfetcher.main()
 
 
@@ -47,6 +47,17 @@ def get_referer(url):
     path = os.path.dirname(path)
     return urlparse.urlunsplit((scheme, netloc, path, None, None))
 
+def normalize_url(url):
+    """Canonical form of a url: scheme and host in lower case, no default
+    port and no fragment"""
+    pack = urlparse.urlsplit(url)
+    scheme = pack.scheme.lower()
+    port = pack.port
+    if (scheme, port) in (("ftp", 21), ("http", 80), ("https", 443)):
+        port = None
+    netloc = assemble_netloc(pack.username, pack.password, pack.hostname or "", port)
+    return urlparse.urlunsplit((scheme, netloc, pack.path or "/", pack.query, None))
+
 def truncate_url(width, s):
     if len(s) > width:
         filler = "..."
@@ -21,9 +21,15 @@ class Web(object):
     def __init__(self, root=None):
         self.root = None
         self.index = {}
+        self.hashes = {}    # content hash -> node
         if root:
             self.add_url(root, [])
 
+    def __setstate__(self, state):
+        # webs saved before there was a hash index
+        state.setdefault("hashes", {})
+        self.__dict__.update(state)
+
     def __contains__(self, e):
         return e in self.index
 
@@ -53,6 +59,37 @@ class Web(object):
         self.index[new_url] = self.index[url]
         self.index[url].aliases.append(new_url)
 
+    def add_hash(self, url, digest):
+        """Record the content hash of url. If another node already has the
+        same content url becomes an alias of it, and that node is returned."""
+        node = self.index[url]
+        orig = self.hashes.get(digest)
+        if not orig:
+            self.hashes[digest] = node
+        elif orig is not node:
+            self.add_alias(orig.url, url)
+            return orig
+
+    def add_alias(self, url, dup_url):
+        """Fold the node of dup_url into the node of url"""
+        node = self.index[url]
+        dup = self.index[dup_url]
+        for (u, n) in dup.incoming.items():
+            n.outgoing.pop(dup.url, None)
+            if n is not node:
+                n.outgoing[node.url] = node
+                node.incoming[u] = n
+        for (u, n) in dup.outgoing.items():
+            n.incoming.pop(dup.url, None)
+            if n is not node:
+                n.incoming[node.url] = node
+                node.outgoing[u] = n
+        for u in dup.aliases:
+            self.index[u] = node
+            node.aliases.append(u)
+        if self.root is dup:
+            self.root = node
+
     def get(self, url):
         return self.index.get(url)
 
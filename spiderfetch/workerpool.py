@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import sys
+import threading
+import time
+import traceback
+
+from spiderfetch import ioutils
+from spiderfetch import urlrewrite
+from spiderfetch.compat import queue
+
+
+# how many connections to open to the same host unless told otherwise, so
+# that a crawl of a single site doesn't use every worker against it
+HOST_CONNS = 4
+
+
+class WorkerPool(object):
+    """Runs func(record) on a fixed set of threads, never having more than
+    host_conns records in flight against the same host. Finished records are
+    handed back to the calling thread through get(), so that any state that
+    isn't thread safe can be updated there. With a limiter, records for a
+    host that has run out of requests wait their turn without taking up a
+    worker."""
+
+    def __init__(self, func, workers, host_conns=None, limiter=None):
+        self.func = func
+        self.workers = workers
+        self.host_conns = host_conns or min(workers, HOST_CONNS)
+        self.limiter = limiter
+
+        self.waiting = {}   # host -> deque of records not yet started
+        self.inflight = {}  # host -> number of records being worked on
+        self.active = 0
+
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.threads = []
+
+    def __len__(self):
+        return self.active + sum([len(d) for d in self.waiting.values()])
+
+    def start(self):
+        for _ in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        self.threads = []
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            (host, record) = job
+            result = None
+            try:
+                result = self.func(record)
+            except Exception:
+                # func is expected to report its own errors, but the
+                # thread must survive so that the record is accounted for
+                ioutils.write_err(traceback.format_exc())
+            self.results.put((host, record, result))
+
+    def submit(self, record):
+        host = urlrewrite.get_hostname(record.get("url"))
+        if host not in self.waiting:
+            self.waiting[host] = collections.deque()
+        self.waiting[host].append(record)
+
+    def dispatch(self):
+        """Start what records we can, returns the number of seconds until
+        the limiter lets through the next one that had to wait, if any"""
+        wait = None
+        for host in list(self.waiting.keys()):
+            if self.active >= self.workers:
+                break
+            records = self.waiting[host]
+            while (records and self.active < self.workers and
+                   self.inflight.get(host, 0) < self.host_conns):
+                if self.limiter:
+                    delay = self.limiter.request_delay(host)
+                    if delay > 0:
+                        wait = min(wait or delay, delay)
+                        break
+                    self.limiter.take_request(host)
+                self.inflight[host] = self.inflight.get(host, 0) + 1
+                self.active += 1
+                self.run(host, records.popleft())
+            if not records:
+                del self.waiting[host]
+        return wait
+
+    def run(self, host, record):
+        self.jobs.put((host, record))
+
+    def get(self, timeout=None):
+        """Wait for the next record to finish, returns (record, result), or
+        None if none has finished within timeout seconds"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            wait = self.dispatch()
+            # block with a timeout so that Ctrl+C gets through on python 2
+            block = min(wait or 1, 1)
+            if deadline:
+                block = min(block, max(deadline - time.time(), 0))
+            try:
+                (host, record, result) = self.results.get(True, block)
+                break
+            except queue.Empty:
+                if deadline and time.time() >= deadline:
+                    return None
+        self.active -= 1
+        self.inflight[host] -= 1
+        return record, result
+
+
+def testsuite():
+    """Run records for two hosts on more workers than either may use"""
+    lock = threading.Lock()
+    (inflight, peak) = ({}, {})
+
+    def func(record):
+        host = urlrewrite.get_hostname(record["url"])
+        with lock:
+            inflight[host] = inflight.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), inflight[host])
+        time.sleep(0.05)
+        with lock:
+            inflight[host] -= 1
+        return record["url"]
+
+    pool = WorkerPool(func, 4, host_conns=2)
+    pool.start()
+    urls = ["http://%s/%s" % (host, i) for host in ("a", "b") for i in range(6)]
+    for url in urls:
+        pool.submit({"url": url})
+    results = []
+    while len(pool):
+        (record, result) = pool.get()
+        results.append(result)
+    pool.stop()
+    checks = [("all records done", sorted(results) == sorted(urls)),
+              ("at most 2 per host", max(peak.values()) == 2),
+              ("default host_conns", WorkerPool(func, 16).host_conns == HOST_CONNS)]
+    for (name, ok) in checks:
+        print("%s: %s" % (name, ok))
+    return all([ok for (_, ok) in checks])
+
+
+
+if __name__ == "__main__":
+    sys.exit(not testsuite())